@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+import protein_lib as oligo
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import tempfile
+import optparse
+import platform
+import subprocess
+import tracemalloc
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+def main():
+   usage = "usage: %prog [options]"
+   option_parser = optparse.OptionParser( usage )
+
+   add_program_options( option_parser )
+
+   options, arguments = option_parser.parse_args()
+
+   scales = options.scale if options.scale else [ "100x500", "500x1000", "1000x3000" ]
+
+   results = { 'python': platform.python_version(),
+               'options': { 'window_size': options.windowSize,
+                            'step_size': options.stepSize,
+                            'xmer_size': options.XmerWindowSize,
+                            'gap_density': options.gapDensity,
+                            'x_frequency': options.xFrequency,
+                            'seed': options.seed
+                          },
+               'benchmarks': []
+             }
+
+   work_dir = tempfile.mkdtemp( prefix = "protein_lib_bench_" )
+
+   for scale in scales:
+      num_seqs, length = parse_scale( scale )
+      alignment = os.path.join( work_dir, "synthetic_%dx%d.fasta" % ( num_seqs, length ) )
+
+      write_synthetic_alignment( alignment, num_seqs, length, options.gapDensity,
+                                 options.xFrequency, options.seed
+                               )
+
+      for benchmark in run_scale( alignment, scale, options ):
+         results[ 'benchmarks' ].append( benchmark )
+         print( "%-10s %-20s %10.3f s %12.1f KiB" % ( benchmark[ 'scale' ], benchmark[ 'name' ],
+                                                      benchmark[ 'seconds' ], benchmark[ 'peak_kib' ]
+                                                    )
+              )
+
+   shutil.rmtree( work_dir )
+
+   with open( options.outPut, 'w' ) as out_file:
+      json.dump( results, out_file, indent = 2 )
+
+   if options.baseline:
+      with open( options.baseline, 'r' ) as in_file:
+         baseline = json.load( in_file )
+
+      regressions = find_regressions( baseline, results, options.tolerance,
+                                     options.minSeconds, options.minKib
+                                   )
+      for name, scale, metric, old, new in regressions:
+         print( "REGRESSION %s %s %s: %.3f -> %.3f" % ( scale, name, metric, old, new ) )
+      if regressions:
+         sys.exit( 1 )
+
+
+def parse_scale( scale ):
+   """
+      Parses a scale of the form NUMxLEN into the integer number of
+      sequences and the integer length of each sequence
+   """
+   num_seqs, length = scale.lower().split( 'x' )
+   return int( num_seqs ), int( length )
+
+
+def write_synthetic_alignment( output_name, num_seqs, length, gap_density, x_frequency, seed ):
+   """
+      Writes a reproducible synthetic alignment of num_seqs sequences of length columns.
+      Each sequence is a mutated copy of a random reference, in which each
+      position is a gap with probability gap_density, and an 'X' with
+      probability x_frequency. Gaps are also placed in runs, as found in real alignments.
+   """
+   generator = random.Random( seed )
+   reference = [ generator.choice( AMINO_ACIDS ) for index in range( length ) ]
+
+   def records():
+      for sequence_index in range( num_seqs ):
+         sequence = []
+         for column in range( length ):
+            draw = generator.random()
+            if draw < gap_density:
+               sequence.append( '-' )
+            elif draw < gap_density + x_frequency:
+               sequence.append( 'X' )
+            elif draw < gap_density + x_frequency + 0.1:
+               sequence.append( generator.choice( AMINO_ACIDS ) )
+            else:
+               sequence.append( reference[ column ] )
+
+         run_start = generator.randrange( length )
+         run_end = min( length, run_start + int( length * gap_density ) )
+         sequence[ run_start: run_end ] = '-' * ( run_end - run_start )
+
+         yield "synthetic_%d" % sequence_index, ''.join( sequence )
+
+   oligo.write_fasta_records( records(), output_name )
+
+
+def run_scale( alignment, scale, options ):
+   """
+      Runs each of the benchmarks on alignment
+
+      Returns:
+         a list of dicts, one for each benchmark
+   """
+   gap_constraint = options.percentValid
+   names, sequences = oligo.read_fasta_lists( alignment )
+
+   windows = []
+   for sequence in sequences:
+      windows.extend( oligo.subset_lists_iter( "", sequence, options.windowSize,
+                                               options.stepSize, True
+                                             )[ 1 ]
+                    )
+
+   benchmarks = [ ( "read_fasta_lists", lambda: oligo.read_fasta_lists( alignment ) ),
+                  ( "read_alignment", lambda: oligo.read_alignment( alignment ) ),
+                  ( "subset_lists_iter", lambda: [ oligo.subset_lists_iter( name, sequence, options.windowSize,
+                                                                            options.stepSize, True, gap_constraint
+                                                                          )
+                                                   for name, sequence in zip( names, sequences )
+                                                 ]
+                  ),
+                  ( "get_kmers_from_seqs", lambda: oligo.get_kmers_from_seqs( names, sequences, options.windowSize,
+                                                                              options.stepSize, True, gap_constraint
+                                                                            )
+                  ),
+                  ( "is_valid_sequence", lambda: [ oligo.is_valid_sequence( window, gap_constraint ) for window in windows ] )
+                ]
+
+   results = list()
+   for name, function in benchmarks:
+      seconds, peak_kib = time_function( function, options.repeat )
+      results.append( make_result( name, scale, seconds, peak_kib ) )
+
+   seconds, peak_kib = time_main( alignment, options )
+   results.append( make_result( "protein_oligo_main", scale, seconds, peak_kib ) )
+
+   return results
+
+
+def make_result( name, scale, seconds, peak_kib ):
+   return { 'name': name, 'scale': scale, 'seconds': seconds, 'peak_kib': peak_kib }
+
+
+def time_function( function, repeat ):
+   """
+      Times function, returning the best wall time in seconds of repeat runs,
+      and the peak memory allocated by the function in KiB, as seen by tracemalloc
+   """
+   best = None
+   for run in range( repeat ):
+      start = time.perf_counter()
+      function()
+      elapsed = time.perf_counter() - start
+      if best is None or elapsed < best:
+         best = elapsed
+
+   # Memory is traced in a separate run, tracing slows everything down
+   tracemalloc.start()
+   function()
+   peak = tracemalloc.get_traced_memory()[ 1 ]
+   tracemalloc.stop()
+
+   return best, peak / 1024.0
+
+
+def time_main( alignment, options ):
+   """
+      Runs protein_oligo_main.py on alignment in a child process, repeat times
+
+      Returns:
+         the best wall time in seconds of the runs, and the largest peak
+         resident set size in KiB of any of the runs' own child processes
+   """
+   script = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), "protein_oligo_main.py" )
+   command = [ sys.executable, script, '-a', alignment,
+               '-o', alignment + "_out",
+               '-w', str( options.windowSize ),
+               '-s', str( options.stepSize ),
+               '-x', str( options.XmerWindowSize ),
+               '-p', str( options.percentValid )
+             ]
+
+   best = None
+   peak_kib = 0
+   for run in range( options.repeat ):
+      start = time.perf_counter()
+      child = subprocess.Popen( command, stdout = subprocess.DEVNULL )
+      # wait4 gives the usage of this child alone, RUSAGE_CHILDREN would
+      # report the largest peak of any child waited for so far
+      pid, status, usage = os.wait4( child.pid, 0 )
+      elapsed = time.perf_counter() - start
+      child.returncode = os.waitstatus_to_exitcode( status )
+      if child.returncode:
+         raise subprocess.CalledProcessError( child.returncode, command )
+
+      if best is None or elapsed < best:
+         best = elapsed
+      # ru_maxrss is in KiB on Linux
+      peak_kib = max( peak_kib, usage.ru_maxrss )
+
+   return best, float( peak_kib )
+
+
+def find_regressions( baseline, results, tolerance, min_seconds = 0.0, min_kib = 0.0 ):
+   """
+      Compares results against a baseline of a previous run
+
+      Returns:
+         a list of ( name, scale, metric, baseline value, new value ) tuples,
+         one for each metric more than tolerance (a fraction) worse than the baseline,
+         and worse by more than min_seconds or min_kib, so that noise in results too
+         small to matter is not flagged
+   """
+   previous = { ( item[ 'name' ], item[ 'scale' ] ): item for item in baseline[ 'benchmarks' ] }
+   floors = { 'seconds': min_seconds, 'peak_kib': min_kib }
+   regressions = list()
+
+   for item in results[ 'benchmarks' ]:
+      key = ( item[ 'name' ], item[ 'scale' ] )
+      if key not in previous:
+         continue
+      for metric, floor in floors.items():
+         old = previous[ key ][ metric ]
+         if item[ metric ] > old * ( 1 + tolerance ) and item[ metric ] - old > floor:
+            regressions.append( ( item[ 'name' ], item[ 'scale' ], metric, old, item[ metric ] ) )
+
+   return regressions
+
+
+def add_program_options( option_parser ):
+   option_parser.add_option( '--scale', action = "append",
+                             help = ( "Size of a synthetic alignment to benchmark, as NUMxLEN, the number of sequences "
+                                      "and the number of columns. May be given more than once. [100x500, 500x1000, 1000x3000]"
+                                    )
+   )
+   option_parser.add_option( '-g', '--gapDensity', type = 'float', default = 0.2,
+                             help = "Probability that any position of a synthetic sequence is a gap. [0.2]"
+   )
+   option_parser.add_option( '--xFrequency', type = 'float', default = 0.01,
+                             help = "Probability that any position of a synthetic sequence is an 'X'. [0.01]"
+   )
+   option_parser.add_option( '--seed', type = 'int', default = 1,
+                             help = "Seed of the random synthetic alignments, so runs can be compared. [1]"
+   )
+   option_parser.add_option( '-w', '--windowSize', type = 'int', default = 100,
+                             help = "Window size passed to the benchmarked functions. [100]"
+   )
+   option_parser.add_option( '-s', '--stepSize', type = 'int', default = 1,
+                             help = "Step size passed to the benchmarked functions. [1]"
+   )
+   option_parser.add_option( '-x', '--XmerWindowSize', type = 'int', default = 8,
+                             help = "Xmer size passed to protein_oligo_main.py. [8]"
+   )
+   option_parser.add_option( '-p', '--percentValid', type = 'float', default = 99.00,
+                             help = "Gap constraint passed to the benchmarked functions. [99.00]"
+   )
+   option_parser.add_option( '-r', '--repeat', type = 'int', default = 3,
+                             help = "Number of times to time each function, the best time is reported. [3]"
+   )
+   option_parser.add_option( '-o', '--outPut', default = "bench_output.json",
+                             help = "Name of file the JSON results will be written to. [bench_output.json]"
+   )
+   option_parser.add_option( '-b', '--baseline',
+                             help = ( "JSON results of a previous run to compare against. Any time or memory "
+                                      "more than tolerance worse than the baseline is reported, and the "
+                                      "program exits with status 1. [None]"
+                                    )
+   )
+   option_parser.add_option( '-t', '--tolerance', type = 'float', default = 0.10,
+                             help = "Fraction by which a result may be worse than the baseline before it is flagged. [0.10]"
+   )
+   option_parser.add_option( '--minSeconds', type = 'float', default = 0.05,
+                             help = "Smallest increase in seconds over the baseline that is flagged, whatever the tolerance. [0.05]"
+   )
+   option_parser.add_option( '--minKib', type = 'float', default = 1024.0,
+                             help = "Smallest increase in peak KiB over the baseline that is flagged, whatever the tolerance. [1024]"
+   )
+
+
+if __name__ == '__main__':
+   main()
@@ -4,8 +4,28 @@ import sys
 import time
 import subprocess
 import os
+import json
+import shutil
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 
-import protein_oligo_library as oligo
+import protein_lib as oligo
+
+# Maps the index of each task of a job array to the cluster file it works on
+CLUSTER_MANIFEST = "cluster_manifest.txt"
+
+# Manifest of the design array of clusters whose alignment was found in the cache
+CACHED_CLUSTER_MANIFEST = "cached_cluster_manifest.txt"
+
+# Reason squeue gives for a job pending on a dependency that failed
+NEVER_SATISFIED_REASON = "DependencyNeverSatisfied"
+
+# Seconds to wait for the clusters of a finished clustering job to appear
+CLUSTER_DIR_TIMEOUT = 300
+
+# Most tasks submitted in one job array, one less than slurm's default MaxArraySize
+MAX_ARRAY_SIZE = 1000
 
 def main():
     usage = "usage %prog [options]"
@@ -37,14 +57,33 @@ def main():
                        )
                    )
 
+    # Reports are not part of a design, so asking for them does not invalidate the cache
+    cache = None
+    if options.cache_dir:
+        cache = DesignCache( os.path.abspath( options.cache_dir ), oligo_options )
+
+    if options.stats_json:
+        oligo_options += ' --stats_json'
+
+    if options.executor == 'local':
+        executor = LocalExecutor( options.local_workers )
+    else:
+        executor = SlurmExecutor()
+
     if need_to_cluster:
         cluster_script = SBatchScript( "clustering.py " + cluster_options, "slurm_script",
-                                       options.slurm
+                                       options.slurm, executor = executor
            )  
 
         cluster_script.add_module( "python/3.latest" )
         cluster_script.write_script()
-        cluster_script.run()
+        cluster_job = cluster_script.run()
+        cluster_state = executor.wait( [ cluster_job ] )[ cluster_job ]
+        if cluster_state != 'COMPLETED':
+            print( "ERROR: clustering job %s did not complete successfully (%s), no clusters to design from."
+                   % ( cluster_job, cluster_state )
+                 )
+            sys.exit( 1 )
     else:
         if not os.listdir( options.cluster_dir ):
            print( ( "ERROR: directory for clustering is empty, "
@@ -55,47 +94,94 @@ def main():
                 )
            sys.exit( 1 )
 
-    while not os.path.exists( options.cluster_dir ): 
-        time.sleep( 1 )
+    # The clusters of a job that completed may take a while to appear on a shared file system
+    if not wait_for( lambda: os.path.exists( options.cluster_dir ) and os.listdir( options.cluster_dir ),
+                     timeout = CLUSTER_DIR_TIMEOUT
+                   ):
+        print( "ERROR: clustering completed, but no clusters were written to %s." % options.cluster_dir )
+        sys.exit( 1 )
 
     cluster_files = os.listdir( options.cluster_dir )
-    num_files = len( cluster_files )
-
-    while num_files < 1:
-        time.sleep( 1 )
-        num_files = len( os.listdir( options.cluster_dir ) )
     
     os.chdir( options.cluster_dir )
 
     job_ids = {}
     oligo_ids = list()
 
-    for current_file in cluster_files:
-        if os.path.isfile( current_file ) and ".fasta" in current_file:
-            alignment_command = "-in %s -out %s.aligned" % ( current_file, current_file )
-            alignment_script = SBatchScript( "muscle " + alignment_command, "muscle_script", options.slurm )
-            alignment_script.add_slurm_arg( "--job-name " + current_file )
-            alignment_script.add_module( 'muscle ' )
-            alignment_script.write_script()
-            current_job_id = alignment_script.run()
-            job_ids[ current_file + ".aligned" ] = current_job_id
+    # Maps each cluster file to the job that designs from it
+    design_jobs = {}
+
+    # Alignments and designs left in the directory by an earlier run are not clusters
+    cluster_fastas = [ current_file for current_file in cluster_files
+                       if os.path.isfile( current_file ) and ".fasta" in current_file
+                       and ".aligned" not in current_file
+                     ]
+
+    # Clusters whose alignment is cached only need to be designed from,
+    # those whose design is cached as well need nothing at all
+    aligned_fastas = list()
+    if cache:
+        cluster_fastas, aligned_fastas = cache.restore( cluster_fastas )
+
+    # The local executor has no scheduler to spare, so only slurm runs use job arrays
+    if options.job_array and options.executor == 'slurm':
+        for manifest, files, align in ( ( CLUSTER_MANIFEST, cluster_fastas, True ),
+                                        ( CACHED_CLUSTER_MANIFEST, aligned_fastas, False )
+                                      ):
+            array_ids = submit_job_arrays( files, oligo_options, options.slurm, executor,
+                                           align = align, manifest_name = manifest,
+                                           max_array_size = options.max_array_size
+                                         )
+            design_jobs.update( { current_file: array_ids[ index // options.max_array_size ]
+                                  for index, current_file in enumerate( files )
+                                } )
+            oligo_ids.extend( array_ids )
+        cluster_fastas = list()
+        aligned_fastas = list()
+
+    for current_file in cluster_fastas:
+        alignment_command = "-in %s -out %s.aligned" % ( current_file, current_file )
+        alignment_script = SBatchScript( "muscle " + alignment_command, "muscle_script", options.slurm,
+                                         executor = executor
+                                       )
+        alignment_script.add_slurm_arg( "--job-name " + current_file )
+        alignment_script.add_module( 'muscle ' )
+        alignment_script.write_script()
+        current_job_id = alignment_script.run()
+        job_ids[ current_file + ".aligned" ] = current_job_id
+
+    for current_file in aligned_fastas:
+        job_ids[ current_file + ".aligned" ] = None
+
+    if options.bin_work and job_ids:
+        bins = pack_clusters( cluster_fastas + aligned_fastas, options.bin_work )
+        bin_ids = submit_design_bins( bins, job_ids, oligo_options, options.slurm, executor )
+        for bin_files, job in zip( bins, bin_ids ):
+            design_jobs.update( { current_file: job for current_file in bin_files } )
+        oligo_ids.extend( bin_ids )
+        job_ids = {}
 
     for current_file, job_number in job_ids.items():
         oligo_options += ' -a ' + str( current_file )
         oligo_options += ' -o ' + str( current_file ) + "_out "
 
-        oligo_script = SBatchScript( ".././protein_oligo_main.py" + oligo_options + " -a " + current_file, "oligo_script", options.slurm )
-        oligo_script.add_dependency( job_number )
+        oligo_script = SBatchScript( ".././protein_oligo_main.py" + oligo_options + " -a " + current_file, "oligo_script", options.slurm,
+                                     executor = executor
+                                   )
+        if job_number:
+            oligo_script.add_dependency( job_number )
         oligo_script.add_module( 'python/3.latest' )
         oligo_script.write_script()
         current_job_id = oligo_script.run()
         oligo_ids.append( current_job_id )
+        design_jobs[ current_file[ :-len( ".aligned" ) ] ] = current_job_id
 
     out_file = options.output + ".fasta"
     combination_script = SBatchScript( "cat $(pwd)/*_out > combined.fasta",
                                        "combine_script",
                                         options.slurm,
-                                        dependency_mode = "afterany"
+                                        dependency_mode = "afterany",
+                                        executor = executor
                                      )
     combination_script.add_command( "mv combined.fasta ../" + out_file )
     combination_script.add_dependencies( oligo_ids )
@@ -104,15 +190,33 @@ def main():
 
 
     os.chdir( ".." )
-    while not combination_script.is_finished():
-        time.sleep( 1 )
-
-
-    # names, sequences = oligo.read_fasta_lists( out_file )
-    # names, sequences = oligo.get_unique_sequences( names, sequences )
-
-    # os.remove( out_file )
-    # oligo.write_fastas( names, sequences, out_file )
+    states = executor.wait()
+
+    failed_jobs = [ job for job, state in states.items() if state != 'COMPLETED' ]
+    if failed_jobs:
+        print( "WARNING: %d jobs did not complete successfully: %s" %
+               ( len( failed_jobs ),
+                 ', '.join( "%s (%s)" % ( job, states[ job ] ) for job in failed_jobs )
+               )
+             )
+
+    # Only results of jobs that succeeded are kept for later runs
+    if cache:
+        for current_file, job in design_jobs.items():
+            if states.get( job ) == 'COMPLETED':
+                cache.store( os.path.join( options.cluster_dir, current_file ) )
+
+    if options.stats_json:
+        summarize_stats( options.cluster_dir, options.output + ".stats.json" )
+
+    # Oligos designed for different clusters may be identical, only keep one of each
+    if os.path.exists( out_file ):
+        deduplicated_file = out_file + ".unique"
+        oligo.deduplicate_fasta( out_file, deduplicated_file,
+                                 memory_budget = options.dedup_memory * ( 1 << 20 ),
+                                 work_dir = "."
+                               )
+        os.replace( deduplicated_file, out_file )
 
 
 def add_program_options( option_parser ):
@@ -199,6 +303,354 @@ def add_program_options( option_parser ):
     )
     )
 
+    option_parser.add_option( '--executor', default = 'slurm', choices = [ 'slurm', 'local' ],
+                              help = ( "Where to run the clustering, alignment, and design steps. 'slurm' submits "
+                                       "each step with sbatch, 'local' runs them on this machine, across "
+                                       "--local_workers processes. [slurm]"
+                                     )
+                            )
+
+    option_parser.add_option( '--local_workers', type = 'int',
+                              help = "Number of steps to run at once with the local executor. [number of cores]"
+                            )
+
+    option_parser.add_option( '--job_array', action = "store_true",
+                              help = ( "Include to submit the alignment of every cluster as one slurm array job, "
+                                       "and the design of every cluster as one dependent array job, instead of "
+                                       "submitting two jobs per cluster. Ignored by the local executor."
+                                     )
+                            )
+
+    option_parser.add_option( '--max_array_size', type = 'int', default = MAX_ARRAY_SIZE,
+                              help = ( "Most clusters submitted in one array job with --job_array, more clusters are "
+                                       "split across several arrays. Must be less than slurm's MaxArraySize. [%d]" % MAX_ARRAY_SIZE
+                                     )
+                            )
+
+    option_parser.add_option( '--bin_work', type = 'int',
+                              help = ( "Include to group clusters into design jobs whose estimated work, the number "
+                                       "of sequences times the length of the longest sequence of each cluster, adds up "
+                                       "to at most this value, so small clusters share a job instead of each starting "
+                                       "its own. Not used with --job_array. [None, one design job per cluster]"
+                                     )
+                            )
+
+    option_parser.add_option( '--dedup_memory', type = 'int', default = 1024, help = (
+        "Memory in MB the removal of duplicate oligos from the combined library may use "
+        "before it spills to partitions on disk. [1024]"
+    )
+    )
+
+    option_parser.add_option( '--cache_dir', help = (
+        "Directory to keep the alignment and design of each cluster in, keyed by the contents of "
+        "the cluster, the design options, and the versions of muscle and of the design scripts. Clusters "
+        "with a result in the cache are not aligned or designed from again. [None, no cache]"
+    )
+    )
+
+    option_parser.add_option( '--stats_json', action = "store_true", help = (
+        "Include to have each design job record the time and memory used by each of its stages, "
+        "and to gather these reports into a summary written to the output name with .stats.json appended."
+    )
+    )
+
+
+def submit_job_arrays( cluster_files, oligo_options, slurm_args, executor,
+                       align = True, manifest_name = CLUSTER_MANIFEST, max_array_size = MAX_ARRAY_SIZE
+                     ):
+    """
+        Submits the alignment of cluster_files as slurm array jobs of at most
+        max_array_size tasks each, and the design of each of these chunks as an array
+        job that depends upon its alignment array, so that task i of a design array
+        runs once task i of its alignment array succeeds, and is cancelled by the
+        JobMonitor if that task fails. Task i of each array of
+        chunk k works on line i + 1 of the manifest of chunk k, which is written with
+        the name of one of the chunk's cluster files per line.
+
+        :param cluster_files: names of the cluster fasta files to align and design from
+        :param oligo_options: options passed to protein_oligo_main.py for each cluster
+        :param slurm_args: slurm arguments written to every array script
+        :param executor: SlurmExecutor the array jobs are submitted to
+        :param align: False if cluster_files are already aligned, in which case
+                      only the design arrays are submitted
+        :param manifest_name: name of the manifest file to write, the number of
+                              each chunk is added before its extension
+        :param max_array_size: most tasks of any one array job
+
+        :returns: list of the job numbers of the design arrays, the one at index k
+                  designing from cluster_files[ k * max_array_size: ( k + 1 ) * max_array_size ],
+                  empty if there are no cluster files
+    """
+    manifest_base, manifest_extension = os.path.splitext( manifest_name )
+    oligo_ids = list()
+
+    for chunk, start in enumerate( range( 0, len( cluster_files ), max_array_size ) ):
+        chunk_files = cluster_files[ start: start + max_array_size ]
+        chunk_manifest = "%s_%d%s" % ( manifest_base, chunk, manifest_extension )
+
+        with open( chunk_manifest, 'w' ) as manifest:
+            for current_file in chunk_files:
+                manifest.write( current_file + "\n" )
+
+        cluster = '$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" %s)' % chunk_manifest
+        array_arg = "--array 0-%d" % ( len( chunk_files ) - 1 )
+
+        oligo_script = SBatchScript( ".././protein_oligo_main.py" + oligo_options +
+                                     " -a %s.aligned -o %s.aligned_out" % ( cluster, cluster ),
+                                     "%s_%d" % ( "oligo_array_script" if align else "oligo_cached_array_script", chunk ),
+                                     slurm_args, dependency_mode = "aftercorr", executor = executor
+                                   )
+
+        if align:
+            alignment_script = SBatchScript( "muscle -in %s -out %s.aligned" % ( cluster, cluster ),
+                                             "muscle_array_script_%d" % chunk, slurm_args, executor = executor
+                                           )
+            alignment_script.add_slurm_arg( array_arg )
+            alignment_script.add_module( 'muscle ' )
+            alignment_script.write_script()
+            oligo_script.add_dependency( alignment_script.run() )
+
+        oligo_script.add_slurm_arg( array_arg )
+        oligo_script.add_module( 'python/3.latest' )
+        oligo_script.write_script()
+        oligo_ids.append( oligo_script.run() )
+
+    return oligo_ids
+
+def estimate_design_work( cluster_file ):
+    """
+        Estimates the work of designing from cluster_file as the number of
+        sequences it holds times the length of the longest of them, a lower
+        bound of the size of its alignment
+    """
+    names, offsets, lengths = oligo.build_fasta_index( cluster_file )
+    return len( names ) * max( lengths, default = 0 )
+
+def pack_clusters( cluster_files, capacity ):
+    """
+        Groups cluster_files into bins whose estimated design work adds up to at most
+        capacity, placing the largest clusters first, each in the first bin it fits in.
+        A cluster whose work alone is more than capacity is given a bin of its own.
+
+        :returns: list of bins, each a list of cluster file names
+    """
+    work = { current_file: estimate_design_work( current_file ) for current_file in cluster_files }
+    bins = list()
+    loads = list()
+
+    for current_file in sorted( cluster_files, key = lambda name: ( -work[ name ], name ) ):
+        for index in range( len( bins ) ):
+            if loads[ index ] + work[ current_file ] <= capacity:
+                bins[ index ].append( current_file )
+                loads[ index ] += work[ current_file ]
+                break
+        else:
+            bins.append( [ current_file ] )
+            loads.append( work[ current_file ] )
+
+    return bins
+
+def submit_design_bins( bins, alignment_jobs, oligo_options, slurm_args, executor ):
+    """
+        Submits one design job for each bin of clusters, which runs protein_oligo_main.py
+        once, designing from every cluster of the bin within that one process.
+        Each cluster's output and stats are written just as by a job of its own.
+
+        :param bins: list of lists of cluster file names, as made by pack_clusters
+        :param alignment_jobs: dict mapping the name of each aligned cluster file
+                               to the job number of its alignment, or None if
+                               it is already aligned
+        :returns: list of the job numbers of the design jobs
+    """
+    oligo_ids = list()
+
+    for index, bin_files in enumerate( bins ):
+        batch_name = "design_bin_%d.txt" % index
+        with open( batch_name, 'w' ) as batch_file:
+            for current_file in bin_files:
+                batch_file.write( "%s.aligned\t%s.aligned_out\n" % ( current_file, current_file ) )
+
+        oligo_script = SBatchScript( ".././protein_oligo_main.py" + oligo_options + " --batch " + batch_name,
+                                     "oligo_bin_script", slurm_args, executor = executor
+                                   )
+        oligo_script.add_dependencies( [ alignment_jobs[ current_file + ".aligned" ] for current_file in bin_files
+                                         if alignment_jobs[ current_file + ".aligned" ]
+                                       ]
+                                     )
+        oligo_script.add_module( 'python/3.latest' )
+        oligo_script.write_script()
+        oligo_ids.append( oligo_script.run() )
+
+    return oligo_ids
+
+def summarize_stats( cluster_dir, output_name ):
+    """
+        Gathers the stats reports written by protein_oligo_main.py --stats_json
+        for each cluster in cluster_dir into a single summary of the run
+
+        :param cluster_dir: directory containing the per-cluster reports
+        :param output_name: name of the JSON file to write the summary to
+    """
+    stats_suffix = ".stats.json"
+    clusters = {}
+    totals = {}
+
+    for current_file in sorted( os.listdir( cluster_dir ) ):
+        if not current_file.endswith( stats_suffix ):
+            continue
+
+        with open( os.path.join( cluster_dir, current_file ), 'r' ) as in_file:
+            report = json.load( in_file )
+        clusters[ current_file[ :-len( stats_suffix ) ] ] = report
+
+        for name, stage in report[ 'stages' ].items():
+            total = totals.setdefault( name, { 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                               'peak_rss_kib': 0, 'items': 0
+                                             }
+                                     )
+            total[ 'wall_seconds' ] += stage[ 'wall_seconds' ]
+            total[ 'cpu_seconds' ] += stage[ 'cpu_seconds' ]
+            total[ 'peak_rss_kib' ] = max( total[ 'peak_rss_kib' ], stage[ 'peak_rss_kib' ] )
+            total[ 'items' ] += stage[ 'items' ]
+
+    with open( output_name, 'w' ) as out_file:
+        json.dump( { 'num_clusters': len( clusters ), 'stages': totals, 'clusters': clusters },
+                   out_file, indent = 2
+                 )
+
+def find_muscle_version():
+    """
+        Runs 'muscle -version' after loading the same muscle module the alignment
+        scripts load, so the version found is that of the muscle the jobs will run.
+        Exits if muscle cannot be run, as its error message would otherwise become
+        part of every cache key.
+
+        :returns: the version string printed by muscle
+    """
+    result = subprocess.run( "if command -v module > /dev/null 2>&1; then module load muscle; fi; muscle -version",
+                             shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT,
+                             universal_newlines = True
+                           )
+    if result.returncode != 0:
+        print( "ERROR: could not find the version of muscle for the cache, 'muscle -version' exited with "
+               "status %d: %s" % ( result.returncode, result.stdout.strip() )
+             )
+        sys.exit( 1 )
+    return result.stdout
+
+class DesignCache:
+    """
+        Cache of the alignments and designs of clusters, shared between runs.
+        Each result is stored under a digest of what it depends upon: the contents
+        of the cluster file and the version of muscle for an alignment, and
+        additionally the design options and the source of the design scripts for
+        a design. A cluster, option, or tool that changes therefore never
+        finds a stale result, and only its own work is done again.
+    """
+    def __init__( self, cache_dir, design_options, muscle_version = None ):
+        """
+            :param cache_dir: directory the cached results are kept in, created if needed
+            :param design_options: options passed to protein_oligo_main.py, not including
+                                   the input and output files
+            :param muscle_version: version of muscle used to align, found
+                                   by find_muscle_version if not given
+        """
+        self.cache_dir = cache_dir
+        os.makedirs( cache_dir, exist_ok = True )
+
+        if muscle_version is None:
+            muscle_version = find_muscle_version()
+
+        self.alignment_salt = "muscle\0%s\0" % muscle_version.strip()
+        self.design_salt = "%s\0%s\0" % ( ' '.join( design_options.split() ), self.source_version() )
+
+    @staticmethod
+    def source_version():
+        """
+            Returns a digest of the scripts that design from an alignment,
+            so that a change to them invalidates every cached design
+        """
+        digest = hashlib.blake2b( digest_size = 16 )
+        script_dir = os.path.dirname( os.path.abspath( __file__ ) )
+        for script in ( "protein_oligo_main.py", "protein_lib.py" ):
+            with open( os.path.join( script_dir, script ), 'rb' ) as in_file:
+                digest.update( in_file.read() )
+        return digest.hexdigest()
+
+    def keys( self, cluster_file ):
+        """
+            Returns the keys of the alignment and of the design of cluster_file
+        """
+        digest = hashlib.blake2b( self.alignment_salt.encode(), digest_size = 16 )
+        with open( cluster_file, 'rb' ) as in_file:
+            for block in iter( lambda: in_file.read( oligo.FASTA_BUFFER_SIZE ), b'' ):
+                digest.update( block )
+        alignment_key = digest.hexdigest()
+
+        digest.update( self.design_salt.encode() )
+        return alignment_key, digest.hexdigest()
+
+    def paths( self, cluster_file ):
+        """
+            Returns a list of ( cluster directory name, cache name ) pairs
+            of each of the files cached for cluster_file, its alignment
+            first, then its design and the stats of its design
+        """
+        alignment_key, design_key = self.keys( cluster_file )
+        return [ ( cluster_file + ".aligned", os.path.join( self.cache_dir, alignment_key + ".aligned" ) ),
+                 ( cluster_file + ".aligned_out", os.path.join( self.cache_dir, design_key + ".out" ) ),
+                 ( cluster_file + ".aligned_out.stats.json", os.path.join( self.cache_dir, design_key + ".stats.json" ) )
+               ]
+
+    def restore( self, cluster_files ):
+        """
+            Copies every cached result of cluster_files next to its cluster file
+
+            :returns: a tuple of the list of cluster files with nothing cached,
+                      which need to be aligned and designed from, and the list
+                      of those with only an alignment cached, which only need
+                      to be designed from
+        """
+        to_align = list()
+        to_design = list()
+
+        for current_file in cluster_files:
+            alignment, design, stats = self.paths( current_file )
+
+            if not self.is_valid( alignment[ 1 ] ):
+                to_align.append( current_file )
+                continue
+
+            shutil.copyfile( alignment[ 1 ], alignment[ 0 ] )
+            if not self.is_valid( design[ 1 ] ):
+                to_design.append( current_file )
+                continue
+
+            shutil.copyfile( design[ 1 ], design[ 0 ] )
+            if os.path.exists( stats[ 1 ] ):
+                shutil.copyfile( stats[ 1 ], stats[ 0 ] )
+
+        print( "Found %d of %d clusters in the cache, %d more were already aligned" %
+               ( len( cluster_files ) - len( to_align ) - len( to_design ), len( cluster_files ), len( to_design ) )
+             )
+        return to_align, to_design
+
+    def store( self, cluster_file ):
+        """
+            Adds the alignment and design of cluster_file, and the stats of
+            the design if there are any, to the cache. Each file is copied to a
+            temporary name first, so an interrupted copy is never taken for a result.
+        """
+        for local_name, cache_name in self.paths( cluster_file ):
+            if not self.is_valid( local_name ):
+                continue
+            temp_name = cache_name + ".tmp%d" % os.getpid()
+            shutil.copyfile( local_name, temp_name )
+            os.replace( temp_name, cache_name )
+
+    @staticmethod
+    def is_valid( file_name ):
+        return os.path.isfile( file_name ) and os.path.getsize( file_name ) > 0
 
 def check_required_option( option, string, exit_on_failure = False ):
     """
@@ -252,7 +704,7 @@ class SBatchScript:
         any job numbers generated. This class also supports the import of modules,
         if this package is available on your system.
     """
-    def __init__( self, command, script_name, slurm_args, dependency_mode = "afterany" ):
+    def __init__( self, command, script_name, slurm_args, dependency_mode = "afterany", executor = None ):
         """
             Constructor for SBatchScript class
 
@@ -269,9 +721,13 @@ class SBatchScript:
              Note: the #SBATCH flag is written to the file before each of these arguments
         
             :param dependency_mode: Optional mode of dependencies this script is dependant upon.
+
+            :param executor: Optional executor the script is run by, a SlurmExecutor by default.
+                             Scripts that depend on each other must share an executor.
         """
         self.commands = [ SBatchScript.Command( command ) ]
-        self.slurm_args = [ item.split() for item in slurm_args ]
+        self.slurm_args = [ item.split() for item in slurm_args ] if slurm_args else list()
+        self.executor = executor if executor else SlurmExecutor()
         self.script_name = script_name
 
         self.dependencies = list()
@@ -324,29 +780,20 @@ class SBatchScript:
 
     def run( self ):
         """
-            Executes the script, and returns the slurm job number
-
-            Note: this method sets the mode access mode to octal 755 
+            Executes the script through this script's executor,
+            and returns the job number it was given
         """
-        os.chmod( self.script_name, 0o755 )
-        script = subprocess.getoutput( "sbatch " + self.script_name ) 
-
-        # Get and return the jobnumber
-        script = script.split()[ 3 ]
-        self.job_num = script
-
-        return script
+        self.job_num = self.executor.submit( self )
+        return self.job_num
 
     def is_finished( self ):
         """
             Determines whether or not this job has been completed,
-            where completion is determined by an empty output from
-            squeue -h -j $job_num, this method does not determine the
-            success/failure of any given job number, only whether or not
-            it is currently running.
+            this method does not determine the success/failure of
+            any given job number, only whether or not it is still
+            waiting or running.
         """
-        output = subprocess.getoutput( "squeue -h -j " + self.job_num )
-        return not output
+        return self.executor.is_finished( self.job_num )
 
     def set_shebang( self, new_shebang ):
         """
@@ -426,6 +873,314 @@ class SBatchScript:
         """
         self.modules.append( to_add )
        
+class SlurmExecutor:
+    """
+        Runs SBatchScripts by submitting them to slurm with sbatch,
+        and follows the submitted jobs with a JobMonitor
+    """
+    def __init__( self, monitor = None ):
+        self.monitor = monitor if monitor else JobMonitor()
+
+    def submit( self, script ):
+        """
+            Submits script, which must already have been written, and
+            returns the slurm job number
+
+            Note: this method sets the mode access mode to octal 755 
+        """
+        os.chmod( script.script_name, 0o755 )
+        status, output = subprocess.getstatusoutput( "sbatch " + script.script_name ) 
+
+        # Get and return the jobnumber, sbatch prints "Submitted batch job <number>"
+        words = output.split()
+        if status or words[ :3 ] != [ "Submitted", "batch", "job" ] or len( words ) < 4:
+            print( "ERROR: sbatch could not submit %s: %s" % ( script.script_name, output ) )
+            sys.exit( 1 )
+        job_num = words[ 3 ]
+        self.monitor.add_job( job_num )
+        return job_num
+
+    def is_finished( self, job_num ):
+        self.monitor.poll()
+        return self.monitor.is_finished( job_num )
+
+    def wait( self, job_nums = None ):
+        """
+            Waits for job_nums, or every job submitted if not given,
+            and returns a dict mapping each job number to its final state
+        """
+        return self.monitor.wait( job_nums )
+
+
+class LocalExecutor:
+    """
+        Runs SBatchScripts on this machine, in a pool of max_workers threads that
+        each run the commands of one script at a time. A script is only started
+        once the scripts it depends upon have finished, following the same
+        afterok and afterany dependency modes as slurm.
+
+        Commands are run by the shell in the directory that was current when
+        the script was submitted. Slurm arguments, srun, and modules are ignored,
+        so each command's program must already be in the PATH.
+    """
+    def __init__( self, max_workers = None ):
+        self.pool = ThreadPoolExecutor( max_workers if max_workers else os.cpu_count() )
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit( self, script ):
+        """
+            Schedules script to run once its dependencies have finished
+
+            Returns:
+                the job number given to the script
+        """
+        job_num = "local_%d" % ( len( self.jobs ) + 1 )
+        job = Future()
+        self.jobs[ job_num ] = job
+
+        commands = [ str( command ) for command in script.commands ]
+        directory = os.getcwd()
+        dependencies = [ self.jobs[ str( dependency ) ] for dependency in script.dependencies ]
+        remaining = [ len( dependencies ) ]
+
+        def start():
+            if script.dependency_mode == 'afterok' and \
+               any( dependency.result() != 'COMPLETED' for dependency in dependencies ):
+                job.set_result( 'CANCELLED' )
+                return
+            running = self.pool.submit( LocalExecutor.run_commands, commands, directory )
+            running.add_done_callback( lambda finished: job.set_result( finished.result() ) )
+
+        def dependency_done( finished ):
+            with self.lock:
+                remaining[ 0 ] -= 1
+                ready = remaining[ 0 ] == 0
+            if ready:
+                start()
+
+        if dependencies:
+            for dependency in dependencies:
+                dependency.add_done_callback( dependency_done )
+        else:
+            start()
+
+        return job_num
+
+    @staticmethod
+    def run_commands( commands, directory ):
+        """
+            Runs each of commands in turn, stopping at the first to fail
+
+            Returns:
+                'COMPLETED' if every command succeeded, 'FAILED' otherwise
+        """
+        try:
+            for command in commands:
+                if subprocess.run( command, shell = True, cwd = directory ).returncode != 0:
+                    return 'FAILED'
+        except OSError:
+            return 'FAILED'
+        return 'COMPLETED'
+
+    def is_finished( self, job_num ):
+        return self.jobs[ str( job_num ) ].done()
+
+    def wait( self, job_nums = None ):
+        """
+            Waits for job_nums, or every job submitted if not given,
+            and returns a dict mapping each job number to its final state
+        """
+        if job_nums is None:
+            job_nums = list( self.jobs )
+        return { str( job ): self.jobs[ str( job ) ].result() for job in job_nums }
+
+
+class JobMonitor:
+    """
+        Tracks the state of a set of slurm jobs, asking the scheduler about every
+        outstanding job in a single squeue call, and about jobs that have left
+        the queue in a single sacct call. Polls are made with exponential
+        backoff, so a long wait does not keep querying the scheduler controller.
+
+        The function used to run scheduler commands can be replaced, so that the
+        monitor can be run against a local fake of squeue and sacct.
+    """
+    TERMINAL_STATES = { 'COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'NODE_FAIL',
+                        'PREEMPTED', 'OUT_OF_MEMORY', 'BOOT_FAIL', 'DEADLINE',
+                        'UNKNOWN'
+                      }
+
+    # Polls in which squeue and sacct both answered without mentioning a job
+    # before it is given up on, for clusters that keep no accounting records
+    MAX_MISSING_POLLS = 5
+
+    def __init__( self, run_command = subprocess.getstatusoutput, initial_delay = 1,
+                  max_delay = 60, backoff = 2, sleep = time.sleep
+                ):
+        """
+            :param run_command: function that runs a shell command string and
+                                returns its exit status and its output as a string
+            :param initial_delay: seconds to wait before the second poll
+            :param max_delay: largest number of seconds to wait between polls
+            :param backoff: factor the delay is multiplied by after each poll
+                            in which no job finished
+            :param sleep: function used to wait for a number of seconds
+        """
+        self.run_command = run_command
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.sleep = sleep
+        self.states = {}
+        self.missing_polls = {}
+
+    def add_job( self, job_num ):
+        self.states[ str( job_num ) ] = 'PENDING'
+
+    def add_jobs( self, job_num_list ):
+        for job_num in job_num_list:
+            self.add_job( job_num )
+
+    def outstanding( self ):
+        """
+            Returns a list of the jobs that have not reached a terminal state
+        """
+        return [ job for job, state in self.states.items() if state not in JobMonitor.TERMINAL_STATES ]
+
+    def is_finished( self, job_num ):
+        return self.states[ str( job_num ) ] in JobMonitor.TERMINAL_STATES
+
+    def poll( self ):
+        """
+            Updates the state of each outstanding job
+
+            Returns:
+                the number of jobs that reached a terminal state in this poll
+        """
+        outstanding = self.outstanding()
+        if not outstanding:
+            return 0
+
+        # A controller that is too busy to answer gives no information about any job,
+        # the states are left as they were until a later poll. squeue also fails when
+        # none of the jobs are known to the controller any longer, as they have all finished
+        status, output = self.run_command( "squeue -h -o '%%i %%T %%r' -j %s" % ','.join( outstanding ) )
+        if status and "Invalid job id" not in output:
+            return 0
+        queued = self._parse_states( output ) if not status else {}
+
+        # Unless kill_invalid_depend is set, slurm leaves a job whose dependency can no longer
+        # be met pending forever, such as the design task of a cluster whose alignment failed
+        never_satisfied = self._never_satisfied( output ) if not status else []
+        if never_satisfied:
+            self.run_command( "scancel %s" % ' '.join( never_satisfied ) )
+        for job in outstanding:
+            if job in queued:
+                self.states[ job ] = queued[ job ]
+                self.missing_polls.pop( job, None )
+
+        left_queue = [ job for job in outstanding if job not in queued ]
+        if left_queue:
+            status, output = self.run_command( "sacct -n -X -P -o JobID,State -j %s" % ','.join( left_queue ) )
+            if status:
+                return 0
+            accounted = self._parse_states( output, separator = '|' )
+            for job in left_queue:
+                if job in accounted:
+                    self.states[ job ] = accounted[ job ]
+                    continue
+
+                # A job that has just left the queue may not have an accounting record yet,
+                # it is only taken to have finished, in an unknown state, once it has
+                # been missing from both for MAX_MISSING_POLLS polls
+                self.missing_polls[ job ] = self.missing_polls.get( job, 0 ) + 1
+                if self.missing_polls[ job ] >= JobMonitor.MAX_MISSING_POLLS:
+                    self.states[ job ] = 'UNKNOWN'
+
+        return sum( 1 for job in outstanding if self.is_finished( job ) )
+
+    def wait( self, job_nums = None ):
+        """
+            Polls until each of job_nums, or every job if not given,
+            has reached a terminal state
+
+            Returns:
+                dict mapping each job number waited for to its final state
+        """
+        waiting = [ str( job ) for job in job_nums ] if job_nums is not None else list( self.states )
+        delay = self.initial_delay
+        while True:
+            if self.poll():
+                delay = self.initial_delay
+            if all( self.is_finished( job ) for job in waiting ):
+                return { job: self.states[ job ] for job in waiting }
+
+            self.sleep( delay )
+            delay = min( delay * self.backoff, self.max_delay )
+
+    def _parse_states( self, output, separator = None ):
+        """
+            Parses lines of job number and state, ignoring any other
+            lines, such as errors about job numbers slurm no longer knows
+        """
+        states = {}
+        for line in output.splitlines():
+            fields = line.strip().split( separator )
+            if len( fields ) < 2:
+                continue
+
+            # Tasks of array jobs are reported as job_task, or job_[range] while pending
+            job = fields[ 0 ].split( '_' )[ 0 ]
+            if job not in self.states:
+                continue
+
+            # sacct reports states such as 'CANCELLED by 1234'
+            state = fields[ 1 ].split()[ 0 ] if fields[ 1 ].split() else 'UNKNOWN'
+
+            # A pending job whose dependency can never be met is cancelled by poll
+            if len( fields ) > 2 and fields[ 2 ] == NEVER_SATISFIED_REASON:
+                state = 'CANCELLED'
+
+            # An array job is only finished once every one of its tasks is, and
+            # only completed if every one of its tasks did
+            if job not in states or self._state_rank( state ) > self._state_rank( states[ job ] ):
+                states[ job ] = state
+        return states
+
+    @staticmethod
+    def _state_rank( state ):
+        if state not in JobMonitor.TERMINAL_STATES:
+            return 2
+        return 0 if state == 'COMPLETED' else 1
+
+    def _never_satisfied( self, output ):
+        """
+            Finds the jobs, or tasks of array jobs, in squeue output that
+            are pending on a dependency that can never be satisfied
+        """
+        return [ fields[ 0 ] for fields in ( line.split() for line in output.splitlines() )
+                 if len( fields ) > 2 and fields[ 2 ] == NEVER_SATISFIED_REASON
+                 and fields[ 0 ].split( '_' )[ 0 ] in self.states
+               ]
+
+
+def wait_for( condition, initial_delay = 1, max_delay = 30, backoff = 2, timeout = None ):
+    """
+        Waits, with exponential backoff between checks, until condition
+        returns a true value, or until timeout seconds have passed
+
+        :returns: True if condition was met, False if the wait timed out
+    """
+    delay = initial_delay
+    deadline = time.time() + timeout if timeout is not None else None
+    while not condition():
+        if deadline is not None and time.time() >= deadline:
+            return False
+        time.sleep( delay )
+        delay = min( delay * backoff, max_delay )
+    return True
+
 def check_to_cluster( cluster_dir ):
     if os.path.exists( cluster_dir ):
         return not os.listdir( cluster_dir )
@@ -1,5 +1,218 @@
 #!/usr/bin/env python3
-   
+import os
+import sys
+import mmap
+import gzip
+import lzma
+import bz2
+import io
+import queue
+import threading
+import time
+import json
+import resource
+import hashlib
+import tempfile
+import struct
+import math
+from contextlib import contextmanager
+from array import array
+from itertools import accumulate, islice
+from operator import add, and_, not_, sub
+from bisect import bisect_left
+from collections import deque
+from heapq import heapify, heappush, heappop
+from concurrent.futures import ProcessPoolExecutor
+
+FASTA_BUFFER_SIZE = 1 << 20
+FASTA_INDEX_SUFFIX = ".index"
+# First field of the header line of a fasta index, which records the fasta file it was built from
+FASTA_INDEX_HEADER = "#fasta_index"
+FASTA_WRITE_BATCH = 4096
+
+# Output written to a file with one of these extensions is compressed
+COMPRESSED_OPENERS = { '.gz': gzip.open, '.xz': lzma.open, '.bz2': bz2.open }
+
+# Input starting with one of these signatures is decompressed as it is read
+COMPRESSION_MAGIC = ( ( b'\x1f\x8b', gzip.open ),
+                      ( b'BZh', bz2.open ),
+                      ( b'\xfd7zXZ\x00', lzma.open )
+                    )
+DECOMPRESS_QUEUE_SIZE = 4
+
+# Each residue is encoded in 5 bits, so kmers of up to 12 residues fit in 64 bits.
+# Codes start at 1, so kmers of different lengths never share a code
+KMER_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ*-"
+KMER_CODES = { residue: code + 1 for code, residue in enumerate( KMER_ALPHABET ) }
+KMER_CODE_BITS = 5
+MAX_ENCODED_KMER = 12
+# Any other character, such as a lowercase residue or a '.', is encoded as the unused
+# code 31 followed by its code point in 25 bits, so every kmer still has a unique code,
+# though one that may no longer fit into 64 bits
+KMER_ESCAPE = ( 1 << KMER_CODE_BITS ) - 1
+KMER_ESCAPE_BITS = 25
+KMER_CODE_BUFFER_SIZE = 1 << 20
+KMER_SHARD_SIZE = 64
+
+# Tables for bytes.translate, mapping a character to 1 and every other byte to 0,
+# so that running counts of the character can be taken over the translated bytes
+GAP_FLAGS = bytes( int( code == ord( '-' ) ) for code in range( 256 ) )
+X_FLAGS = bytes( int( code == ord( 'X' ) ) for code in range( 256 ) )
+RESIDUE_FLAGS = [ bytes( int( code == residue ) for code in range( 256 ) ) for residue in range( 256 ) ]
+NOT_RESIDUES = frozenset( ( ord( '-' ), ord( 'X' ) ) )
+
+# Number of window starts whose validity window_validity_mask finds at once
+WINDOW_MASK_BLOCK = 1 << 16
+
+# Number of sequences whose per column 0 or 1 flags can be summed in the byte
+# lanes of an int before a lane could overflow
+BYTE_LANE_LIMIT = 255
+
+# Constants of the splitmix64 finalizer used to hash kmer codes for sketches
+HASH_MASK = ( 1 << 64 ) - 1
+HASH_GOLDEN = 0x9e3779b97f4a7c15
+
+# Most distinct xmers a RedundancySketch gathers before hashing them into its sketches
+SKETCH_BATCH_SIZE = 1 << 16
+
+# A kmer index file starts with this magic, then the xmer size and number of codes,
+# followed by the sorted codes as big-endian integers, so that their bytes sort as they do
+KMER_INDEX_MAGIC = b"KMERIDX1"
+KMER_INDEX_HEADER = struct.Struct( "<8sQQ" )
+
+# Approximate memory used by each sequence digest held in a set
+DIGEST_ENTRY_BYTES = 100
+DIGEST_SIZE = 16
+DEDUP_PARTITIONS = 64
+DEDUP_MEMORY_BUDGET = 1 << 30
+
+def iter_fasta( file_to_read, buffer_size = FASTA_BUFFER_SIZE, background = True ):
+    """
+       Lazily reads the records of a fasta file, one record at a time.
+       gzip, bzip2, and xz compressed files are decompressed as they are read
+
+       Params:
+          file_to_read- name of the fasta file to read
+          buffer_size- number of bytes read from disk at a time
+          background- whether to decompress compressed files in a background thread,
+                      so decompression overlaps with parsing
+       Returns:
+          a generator of ( name, sequence ) tuples, in the order
+          they appear in file_to_read
+    """
+    name = None
+    pieces = []
+
+    with open_input( file_to_read, buffer_size, background ) as file_in:
+        for line in file_in:
+            line = line.strip()
+            if line and line[ 0 ] == '>':
+                if name is not None:
+                    yield name, ''.join( pieces )
+                name = line[ 1: ]
+                pieces = []
+            elif name is not None:
+                pieces.append( line )
+
+    if name is not None:
+        yield name, ''.join( pieces )
+
+def detect_compression( file_to_read ):
+    """
+        Determines whether file_to_read is compressed from its first bytes
+
+        Returns:
+            the function that opens the file for decompression, found in
+            COMPRESSION_MAGIC, or None if the file is not compressed
+    """
+    with open( file_to_read, 'rb' ) as file_in:
+        start = file_in.read( 8 )
+
+    for magic, opener in COMPRESSION_MAGIC:
+        if start.startswith( magic ):
+            return opener
+    return None
+
+def open_input( file_to_read, buffer_size = FASTA_BUFFER_SIZE, background = False ):
+    """
+        Opens file_to_read for reading text, decompressing it if
+        detect_compression finds that it is compressed
+
+        Params:
+            background- whether to decompress in a background thread
+    """
+    opener = detect_compression( file_to_read )
+    if opener is None:
+        return open( file_to_read, 'r', buffering = buffer_size )
+
+    compressed = opener( file_to_read, 'rb' )
+    if background:
+        compressed = io.BufferedReader( BackgroundReader( compressed, buffer_size ), buffer_size )
+    return io.TextIOWrapper( compressed )
+
+class BackgroundReader( io.RawIOBase ):
+    """
+        Reads a binary stream in a background thread, DECOMPRESS_QUEUE_SIZE chunks
+        ahead of the consumer. The compressors of the standard library release
+        the GIL, so decompressing this way overlaps with parsing what has already been read.
+    """
+    def __init__( self, stream, chunk_size ):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue( DECOMPRESS_QUEUE_SIZE )
+        self.current = b''
+        self.finished = False
+        self.stopped = threading.Event()
+
+        self.thread = threading.Thread( target = self._fill, daemon = True )
+        self.thread.start()
+
+    def _fill( self ):
+        try:
+            chunk = self.stream.read( self.chunk_size )
+            while chunk and not self.stopped.is_set():
+                self._put( chunk )
+                chunk = self.stream.read( self.chunk_size )
+            self._put( b'' )
+        except Exception as error:
+            self._put( error )
+
+    def _put( self, item ):
+        while not self.stopped.is_set():
+            try:
+                self.chunks.put( item, timeout = 0.1 )
+                return
+            except queue.Full:
+                pass
+
+    def readable( self ):
+        return True
+
+    def readinto( self, buffer ):
+        if not self.current:
+            if self.finished:
+                return 0
+
+            item = self.chunks.get()
+            if isinstance( item, Exception ):
+                raise item
+            if not item:
+                self.finished = True
+                return 0
+            self.current = item
+
+        count = min( len( buffer ), len( self.current ) )
+        buffer[ :count ] = self.current[ :count ]
+        self.current = self.current[ count: ]
+        return count
+
+    def close( self ):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+            self.stream.close()
+        super().close()
+
 def read_fasta_lists( file_to_read ):
     """
        Reads a list of fastas from file_to_read
@@ -8,42 +221,381 @@ def read_fasta_lists( file_to_read ):
         names- a list of names of the sequences found in the fasta file
         sequences- a list of the sequences found in the fasta file
     """
+    names = []
+    sequences = []
 
-    file_in = open( file_to_read, 'r' )
-    count = 0
+    for name, sequence in iter_fasta( file_to_read ):
+        names.append( name )
+        sequences.append( sequence )
 
+    return names, sequences
+ 
+def open_fasta_records( file_to_read ):
+    """
+        Opens file_to_read for a pass over its records, through an IndexedFasta
+        when the file is plain text, or through iter_fasta when it is compressed
+
+        Returns:
+            an iterable of ( name, sequence ) records, with a close method
+    """
+    if detect_compression( file_to_read ) is not None:
+        return iter_fasta( file_to_read )
+    return IndexedFasta( file_to_read )
+
+def build_fasta_index( file_to_read ):
+    """
+        Builds an index of the records in a fasta file, recording where
+        in the file each record's sequence begins and how many bytes it spans
+
+        Params:
+            file_to_read- name of the fasta file to index
+        Returns:
+            names- a list of the names of the records, in file order
+            offsets- array of the byte offsets at which each record's sequence begins
+            lengths- array of the number of bytes, newlines included, each record's sequence spans
+    """
     names = []
-    sequences = []
-    current_sequence = ''
+    offsets = array( 'q' )
+    lengths = array( 'q' )
+    position = 0
 
-    for line in file_in:
-        line = line.strip()
-        if line and line[ 0 ] == '>':
-            count += 1
-            names.append( line[ 1: ] )
-            if count > 1:
-                sequences.append( current_sequence )
-            current_sequence = ''
+    with open( file_to_read, 'rb', buffering = FASTA_BUFFER_SIZE ) as file_in:
+        for line in file_in:
+            position += len( line )
+            if line[ :1 ] == b'>':
+                if names:
+                    lengths.append( position - len( line ) - offsets[ -1 ] )
+                names.append( line[ 1: ].strip().decode() )
+                offsets.append( position )
 
+    if names:
+        lengths.append( position - offsets[ -1 ] )
+
+    return names, offsets, lengths
+
+def write_fasta_index( index_name, names, offsets, lengths, source_size = -1, source_mtime_ns = -1 ):
+    """
+        Writes an index created by build_fasta_index to index_name, one
+        tab-separated name, offset, and length per line, after a header line
+        recording the size and modification time of the indexed fasta file.
+        The index is written to a temporary file that then replaces index_name,
+        so a reader never finds a partly written index
+    """
+    temp_name = index_name + ".tmp%d" % os.getpid()
+    with open( temp_name, 'w' ) as out_file:
+        out_file.write( "%s\t%d\t%d\n" % ( FASTA_INDEX_HEADER, source_size, source_mtime_ns ) )
+        for index in range( len( names ) ):
+            out_file.write( "%s\t%d\t%d\n" % ( names[ index ], offsets[ index ], lengths[ index ] ) )
+    os.replace( temp_name, index_name )
+
+def read_fasta_index_source( index_name ):
+    """
+        Reads the header of an index written by write_fasta_index
+
+        Returns:
+            the size and the modification time in nanoseconds of the fasta file
+            the index was built from, or None if the index has no header
+    """
+    with open( index_name, 'r' ) as in_file:
+        fields = in_file.readline().rstrip( '\n' ).split( '\t' )
+
+    if len( fields ) != 3 or fields[ 0 ] != FASTA_INDEX_HEADER:
+        return None
+    return int( fields[ 1 ] ), int( fields[ 2 ] )
+
+def read_fasta_index( index_name ):
+    """
+        Reads an index written by write_fasta_index
+
+        Returns:
+            names, offsets, and lengths, as returned by build_fasta_index
+    """
+    names = []
+    offsets = array( 'q' )
+    lengths = array( 'q' )
+
+    with open( index_name, 'r' ) as in_file:
+        for line_number, line in enumerate( in_file ):
+            name, offset, length = line.rstrip( '\n' ).rsplit( '\t', 2 )
+            if line_number == 0 and name == FASTA_INDEX_HEADER:
+                continue
+            names.append( name )
+            offsets.append( int( offset ) )
+            lengths.append( int( length ) )
+
+    return names, offsets, lengths
+
+class IndexedFasta:
+    """
+        Provides random access to the records of a fasta file, by name or by
+        position, through a read-only memory map of the file. The index of the file
+        is stored next to it, with FASTA_INDEX_SUFFIX appended to its name, and
+        is rebuilt whenever the size or modification time of the fasta file
+        differs from those recorded in the index.
+
+        Processes that open the same file share the operating system's
+        page cache instead of each holding their own parsed copy.
+    """
+    def __init__( self, file_to_read, index_name = None ):
+        """
+            :param file_to_read: name of the fasta file to open
+            :param index_name: name of the index file, file_to_read + FASTA_INDEX_SUFFIX
+                               by default
+        """
+        if detect_compression( file_to_read ) is not None:
+            raise ValueError( "Cannot memory map compressed file %s, read it with iter_fasta" % file_to_read )
+
+        self.file_name = file_to_read
+        self.index_name = index_name if index_name else file_to_read + FASTA_INDEX_SUFFIX
+
+        self.names, self.offsets, self.lengths = self._load_index()
+
+        # Where a name is repeated, lookup by name finds its first record
+        self.positions = {}
+        for position, name in enumerate( self.names ):
+            self.positions.setdefault( name, position )
+
+        self._file = open( file_to_read, 'rb' )
+        if os.fstat( self._file.fileno() ).st_size > 0:
+            self._map = mmap.mmap( self._file.fileno(), 0, access = mmap.ACCESS_READ )
         else:
-            current_sequence += line
+            self._map = b''
+
+    def _load_index( self ):
+        # An mtime comparison alone misses a fasta file rewritten within the
+        # timestamp resolution of the index, or replaced by an older file
+        source = os.stat( self.file_name )
+        if os.path.exists( self.index_name ) and \
+           read_fasta_index_source( self.index_name ) == ( source.st_size, source.st_mtime_ns ):
+            return read_fasta_index( self.index_name )
+
+        names, offsets, lengths = build_fasta_index( self.file_name )
+        try:
+            write_fasta_index( self.index_name, names, offsets, lengths, source.st_size, source.st_mtime_ns )
+        except OSError:
+            # The index is a cache, a read-only directory just means rebuilding it next time
+            pass
+        return names, offsets, lengths
+
+    def __len__( self ):
+        return len( self.names )
+
+    def __contains__( self, name ):
+        return name in self.positions
+
+    def __iter__( self ):
+        for position in range( len( self.names ) ):
+            yield self.get_record( position )
+
+    def __getitem__( self, key ):
+        """
+            Returns the ( name, sequence ) record found at integer position key,
+            or the record whose name is key
+        """
+        if isinstance( key, str ):
+            return self.get_record( self.positions[ key ] )
+        return self.get_record( key )
+
+    def get_record( self, position ):
+        return self.names[ position ], self.get_sequence( position )
+
+    def get_sequence( self, position ):
+        """
+            Returns the sequence of the record at position, with
+            any line breaks removed
+        """
+        start = self.offsets[ position ]
+        end = start + self.lengths[ position ]
+        return b''.join( self._map[ start:end ].split() ).decode()
+
+    def close( self ):
+        if isinstance( self._map, mmap.mmap ):
+            self._map.close()
+        self._file.close()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        self.close()
+
+def as_bytes( sequence ):
+    """
+        Returns sequence, a str or a bytes-like object such as a row of an Alignment,
+        as bytes holding one byte per character. Characters that are not ASCII become '?'
+    """
+    if isinstance( sequence, str ):
+        return sequence.encode( 'ascii', 'replace' )
+    return bytes( sequence )
 
-    sequences.append( current_sequence )
-    file_in.close()
+def read_alignment( file_to_read ):
+    """
+        Reads every record of a fasta file, which may be compressed, into an Alignment
+    """
+    return Alignment.from_records( iter_fasta( file_to_read ) )
+
+class Alignment:
+    """
+        Alignment of sequences stored in a single contiguous buffer of one byte per
+        character, with the names of the sequences packed into a second buffer.
+        Rows, and the columns of an alignment whose rows are all the same length,
+        are available as memoryviews of the buffer, so neither is copied. Views
+        must be released before any more sequences are appended.
+
+        An Alignment is an iterable of ( name, sequence ) records, so it may
+        be passed to any function that takes records, such as get_design_from_records.
+        Only the record being worked on is decoded into a str.
+    """
+    def __init__( self ):
+        self.data = bytearray()
+        self.offsets = array( 'q', [ 0 ] )
+        self.name_data = bytearray()
+        self.name_offsets = array( 'q', [ 0 ] )
+        # Length shared by every sequence, None once two differ, kept up to date by append
+        self._width = 0
+
+    @classmethod
+    def from_records( cls, records ):
+        """
+            Creates an Alignment from an iterable of ( name, sequence ) records
+        """
+        alignment = cls()
+        for name, sequence in records:
+            alignment.append( name, sequence )
+        return alignment
+
+    @classmethod
+    def from_lists( cls, names, sequences ):
+        return cls.from_records( zip( names, sequences ) )
+
+    def append( self, name, sequence ):
+        self.data += as_bytes( sequence )
+        self.offsets.append( len( self.data ) )
+
+        length = self.offsets[ -1 ] - self.offsets[ -2 ]
+        if len( self ) == 1:
+            self._width = length
+        elif self._width != length:
+            self._width = None
+
+        self.name_data += name.encode()
+        self.name_offsets.append( len( self.name_data ) )
+
+    def __len__( self ):
+        return len( self.offsets ) - 1
+
+    def __iter__( self ):
+        for position in range( len( self ) ):
+            yield self.get_record( position )
+
+    def __getitem__( self, position ):
+        return self.get_record( position )
+
+    def get_record( self, position ):
+        return self.get_name( position ), self.get_sequence( position )
+
+    def _check_position( self, position ):
+        """
+            Returns position, which may be negative, as an index from the first
+            sequence, raising IndexError if there is no sequence at position
+        """
+        if not -len( self ) <= position < len( self ):
+            raise IndexError( "alignment row out of range" )
+        return position % len( self )
+
+    def get_name( self, position ):
+        position = self._check_position( position )
+        return self.name_data[ self.name_offsets[ position ]: self.name_offsets[ position + 1 ] ].decode()
+
+    def get_sequence( self, position ):
+        """
+            Returns the sequence at position as a str
+        """
+        position = self._check_position( position )
+        return self.data[ self.offsets[ position ]: self.offsets[ position + 1 ] ].decode( 'ascii' )
+
+    def row( self, position ):
+        """
+            Returns a memoryview of the sequence at position, without copying it
+        """
+        position = self._check_position( position )
+        return memoryview( self.data )[ self.offsets[ position ]: self.offsets[ position + 1 ] ]
+
+    def width( self ):
+        """
+            Returns the length shared by every sequence, or None
+            if the sequences are not all the same length
+        """
+        return self._width
+
+    def column( self, position ):
+        """
+            Returns a memoryview of the characters of every sequence
+            at column position, without copying them
+
+            Raises:
+                ValueError if the sequences are not all the same length
+        """
+        width = self.width()
+        if width is None:
+            raise ValueError( "Columns need every sequence of the alignment to be the same length" )
+        if not 0 <= position < width:
+            raise IndexError( "alignment column out of range" )
+        return memoryview( self.data )[ position::width ]
+
+    def get_lists( self ):
+        """
+            Returns a list of the names and a list of the sequences
+            of the alignment, as read_fasta_lists would
+        """
+        return [ self.get_name( position ) for position in range( len( self ) ) ], \
+               [ self.get_sequence( position ) for position in range( len( self ) ) ]
+
+    def close( self ):
+        pass
 
-    return names, sequences
- 
 def write_fastas( names_list, sequence_list, output_name="out.txt" ):
     """
         Writes a fasta file from a list of names and sequences to output file provided
 
     """
-    out_file = open( output_name, 'w+' )
-    for index in range( len( names_list ) ):
-        out_file.write( '>' + names_list[ index ] + '\n' + 
-                        sequence_list[ index ] + '\n'
-                      )
-    out_file.close()
+    write_fasta_records( zip( names_list, sequence_list ), output_name )
+
+def write_fasta_records( records, output_name = "out.txt" ):
+    """
+        Writes a fasta file from an iterable of ( name, sequence ) records,
+        FASTA_WRITE_BATCH records at a time, so records may be a generator.
+        Output is compressed when output_name ends in one of the
+        extensions of COMPRESSED_OPENERS
+
+        Returns:
+            the number of records written
+    """
+    count = 0
+    batch = []
+
+    with open_output( output_name ) as out_file:
+        for name, sequence in records:
+            batch.append( '>%s\n%s\n' % ( name, sequence ) )
+            if len( batch ) == FASTA_WRITE_BATCH:
+                out_file.write( ''.join( batch ) )
+                count += len( batch )
+                batch = []
+
+        out_file.write( ''.join( batch ) )
+        count += len( batch )
+
+    return count
+
+def open_output( output_name ):
+    """
+        Opens output_name for writing text, through a compressor
+        if its extension is found in COMPRESSED_OPENERS
+    """
+    extension = os.path.splitext( output_name )[ 1 ].lower()
+    if extension in COMPRESSED_OPENERS:
+        return COMPRESSED_OPENERS[ extension ]( output_name, 'wt' )
+    return open( output_name, 'w', buffering = FASTA_BUFFER_SIZE )
         
 
 def char_in_string( test_string, character ):
@@ -64,14 +616,9 @@ def percentage_of_char_in_string( test_string, character ):
            is character
     """
     length = len( test_string )
-    char_count = 0.0
-
-    for index in range( length ):
-        if test_string[ index ] == character:
-            char_count += 1
     if length == 0:
         return 0
-    return ( char_count / length ) * 100
+    return ( test_string.count( character ) / float( length ) ) * 100
 
 def count_char_in_string( test_string, character ):
     """
@@ -84,13 +631,77 @@ def count_char_in_string( test_string, character ):
             integer value representing the number of character 
                 were found in test_string
     """
-    length = len( test_string )
-    count = 0
+    return test_string.count( character )
 
-    for index in range( length ):
-        if test_string[ index ] == character:
-            count += 1
-    return count
+def iter_sequence_bytes( sequences ):
+    """
+        Returns a generator of a bytes-like object for each of sequences, a list of
+        str or bytes-like sequences, or an Alignment, whose rows are not copied
+    """
+    if isinstance( sequences, Alignment ):
+        return ( sequences.row( position ) for position in range( len( sequences ) ) )
+    return ( as_bytes( sequence ) for sequence in sequences )
+
+def count_chars( sequences, character ):
+    """
+        Counts character in each of sequences at once
+
+        Params:
+            sequences- list of str or bytes-like sequences, or an Alignment
+            character- single character to count
+        Returns:
+            an array of the integer count of character in each sequence
+    """
+    if isinstance( sequences, Alignment ):
+        data, offsets = sequences.data, sequences.offsets
+        target = character.encode()
+        return array( 'l', ( data.count( target, start, end ) for start, end in zip( offsets, offsets[ 1: ] ) ) )
+
+    if all( isinstance( sequence, str ) for sequence in sequences ):
+        return array( 'l', ( sequence.count( character ) for sequence in sequences ) )
+
+    target = character.encode()
+    return array( 'l', ( sequence.count( target ) for sequence in iter_sequence_bytes( sequences ) ) )
+
+def sequence_lengths( sequences ):
+    """
+        Returns an array of the length of each of sequences, a list of str or
+        bytes-like sequences, or an Alignment, without copying any of them
+    """
+    if isinstance( sequences, Alignment ):
+        offsets = sequences.offsets
+        return array( 'l', map( sub, offsets[ 1: ], offsets[ :-1 ] ) )
+    return array( 'l', map( len, sequences ) )
+
+def percentages_of_char( sequences, character ):
+    """
+        Calculates what percent of each of sequences is character,
+        as percentage_of_char_in_string would for each in turn
+
+        Returns:
+            an array of the floating point percent of each sequence that is character
+    """
+    counts = count_chars( sequences, character )
+    lengths = sequence_lengths( sequences )
+    return array( 'd', ( ( count / float( length ) ) * 100 if length else 0.0
+                         for count, length in zip( counts, lengths )
+                       )
+                )
+
+def remove_chars( sequences, to_remove ):
+    """
+        Removes every to_remove character from each of sequences
+
+        Returns:
+            a list of each sequence, as a str, without any to_remove character
+    """
+    if not isinstance( sequences, Alignment ) and all( isinstance( sequence, str ) for sequence in sequences ):
+        return [ sequence.replace( to_remove, '' ) for sequence in sequences ]
+
+    target = to_remove.encode()
+    return [ bytes( sequence ).translate( None, target ).decode( 'ascii', 'replace' )
+             for sequence in iter_sequence_bytes( sequences )
+           ]
 
 def min_concurrent_chars( test_string, delimeter_char ):
     """
@@ -123,11 +734,7 @@ def remove_char_from_string( test_string, to_remove ):
         Returns:
            test_string, minus any instance of to_remove character
     """
-    output = ""
-    for index in range( len( test_string ) ):
-        if test_string[ index ] != to_remove:
-            output += test_string[ index ]
-    return output
+    return test_string.replace( to_remove, '' )
 
 
 def get_unique_sequences( names_list, sequence_list ):
@@ -168,27 +775,131 @@ def create_list_of_uniques( names, sequences ):
 
     return return_names, return_sequences
 
+def sequence_digest( sequence ):
+    """
+        Hashes sequence into a digest of DIGEST_SIZE bytes
+    """
+    return hashlib.blake2b( sequence.encode(), digest_size = DIGEST_SIZE ).digest()
+
+def deduplicate_fasta( file_to_read, output_name, memory_budget = DEDUP_MEMORY_BUDGET,
+                       num_partitions = DEDUP_PARTITIONS, work_dir = None
+                     ):
+    """
+        Writes the records of file_to_read to output_name, leaving out any record
+        whose sequence has already been written, see deduplicate_records
+
+        Returns:
+            the number of records written
+    """
+    unique = deduplicate_records( iter_fasta( file_to_read ), memory_budget,
+                                  num_partitions, work_dir
+                                )
+    return write_fasta_records( unique, output_name )
+
+def deduplicate_records( records, memory_budget = DEDUP_MEMORY_BUDGET,
+                         num_partitions = DEDUP_PARTITIONS, work_dir = None
+                       ):
+    """
+        Removes records whose sequence was found in an earlier record, streaming
+        records through a set of sequence digests rather than of sequences.
+
+        Once the set would use more than memory_budget bytes, its digests are spilled to
+        num_partitions files on disk, split by the value of the digest, and the remaining
+        records are spilled to matching partitions. Each partition is then deduplicated
+        on its own, so only about 1 / num_partitions of the digests are held at once.
+
+        Params:
+            records- iterable of ( name, sequence ) tuples
+            work_dir- directory in which to create the partitions, the system's
+                      temporary directory by default
+        Returns:
+            a generator of the first record found with each sequence. Records are
+            in their original order, except that once spilling has started the
+            rest are produced one partition at a time
+    """
+    max_digests = max( 1, memory_budget // DIGEST_ENTRY_BYTES )
+    records = iter( records )
+    seen = set()
+
+    for name, sequence in records:
+        digest = sequence_digest( sequence )
+        if digest not in seen:
+            seen.add( digest )
+            yield name, sequence
+
+            if len( seen ) >= max_digests:
+                break
+    else:
+        return
+
+    yield from deduplicate_partitions( records, seen, num_partitions, work_dir )
+
+def deduplicate_partitions( records, seen, num_partitions, work_dir = None ):
+    """
+        Spills the digests of seen and the remaining records to disk partitions,
+        then yields the records of each partition whose sequence is not
+        found in seen or earlier in the partition
+    """
+    def partition_of( digest ):
+        return int.from_bytes( digest[ :4 ], 'big' ) % num_partitions
+
+    with tempfile.TemporaryDirectory( dir = work_dir ) as spill_dir:
+        digest_names = [ os.path.join( spill_dir, "%d.digests" % index ) for index in range( num_partitions ) ]
+        record_names = [ os.path.join( spill_dir, "%d.fasta" % index ) for index in range( num_partitions ) ]
+
+        digest_files = [ open( name, 'wb' ) for name in digest_names ]
+        for digest in seen:
+            digest_files[ partition_of( digest ) ].write( digest )
+        for digest_file in digest_files:
+            digest_file.close()
+        seen.clear()
+
+        record_files = [ open( name, 'w' ) for name in record_names ]
+        for name, sequence in records:
+            record_files[ partition_of( sequence_digest( sequence ) ) ].write( '>%s\n%s\n' % ( name, sequence ) )
+        for record_file in record_files:
+            record_file.close()
+
+        for index in range( num_partitions ):
+            with open( digest_names[ index ], 'rb' ) as digest_file:
+                digests = digest_file.read()
+            partition_seen = { digests[ start: start + DIGEST_SIZE ] for start in range( 0, len( digests ), DIGEST_SIZE ) }
+            del digests
+
+            for name, sequence in iter_fasta( record_names[ index ] ):
+                digest = sequence_digest( sequence )
+                if digest not in partition_seen:
+                    partition_seen.add( digest )
+                    yield name, sequence
+
 def create_valid_sequence_list( names_list, sequence_list, min_length, percent_valid ):
    """
        Creates a sequence list of valid sequences.
        A valid sequence is defined by not having any 'X' characters,
        and not violating the parameters of either min_length or percent_valid 
        
+       Params:
+           sequence_list- list of sequences, or an Alignment
+           min_length- minimum length constraint, used in place of percent_valid when given
        Returns:
-           a list of names of those sequences that were valid, with the new bounds appended to the name
-           a list of the sequences that were found valid
+           a list of names of those sequences that were valid
+           a list of the sequences that were found valid, with their gaps removed
    """
-   valid_names = []
-   valid_sequences = []
+   gap_constraint = min_length if min_length else percent_valid
+
+   gap_counts = count_chars( sequence_list, '-' )
+   x_counts = count_chars( sequence_list, 'X' )
+   lengths = sequence_lengths( sequence_list )
 
-   for sequence in range( len( sequence_list ) ):
-      current_sequence = sequence_list[ sequence ]
+   valid = [ index for index, ( gap_count, x_count, length ) in enumerate( zip( gap_counts, x_counts, lengths ) )
+             if x_count == 0 and meets_gap_constraint( gap_count, length, gap_constraint )
+           ]
 
-      if is_valid_sequence( current_sequence, min_length, percent_valid ):
-           current_sequence = remove_char_from_string( current_sequence, '-' )
-           valid_sequences.append( current_sequence )
-           if names_list:
-               valid_names.append( names_list[ sequence ] )
+   if isinstance( sequence_list, Alignment ):
+       valid_sequences = remove_chars( [ sequence_list.row( index ) for index in valid ], '-' )
+   else:
+       valid_sequences = remove_chars( [ sequence_list[ index ] for index in valid ], '-' )
+   valid_names = [ names_list[ index ] for index in valid ] if names_list else []
 
    return valid_names, valid_sequences
 
@@ -197,17 +908,215 @@ def is_valid_sequence( sequence, gap_constraint ):
        Determines whether a given sequence is valid 
        A valid sequence is defined by not having any 'X' characters,
            and not violating the parameters of either min_length or percent_valid 
+
+       sequence may be a str, or a bytes-like row of an Alignment
    """
-   if sequence.count( 'X' ) == 0:
-       if gap_constraint == None:
-           return True
-       elif isinstance( gap_constraint, float ):
-           return percentage_of_char_in_string( sequence, '-' ) < ( 100 - gap_constraint )
-       elif isinstance( gap_constraint, int ):
-           return ( sequence.count( '-' ) <= len( sequence.replace( '-', '' ) ) - gap_constraint )
+   if isinstance( sequence, str ):
+       gap, unknown = '-', 'X'
+   else:
+       sequence = as_bytes( sequence )
+       gap, unknown = b'-', b'X'
+
+   if unknown not in sequence:
+       return meets_gap_constraint( sequence.count( gap ), len( sequence ), gap_constraint )
    return False
 
-         
+def meets_gap_constraint( gap_count, length, gap_constraint ):
+   """
+       Determines whether a sequence of length characters, gap_count of which
+       are '-', satisfies gap_constraint
+
+       Params:
+           gap_constraint- None for no constraint, a float percent of characters
+                           that must be non '-', or an integer minimum length
+   """
+   if gap_constraint == None:
+       return True
+   elif isinstance( gap_constraint, float ):
+       gap_percent = ( gap_count / float( length ) ) * 100 if length else 0
+       return gap_percent < ( 100 - gap_constraint )
+   elif isinstance( gap_constraint, int ):
+       return gap_count <= ( length - gap_count ) - gap_constraint
+   return False
+
+def max_gaps_allowed( window_size, gap_constraint ):
+   """
+       Finds the largest number of '-' characters a window of window_size
+       characters may contain and still satisfy gap_constraint
+
+       Returns:
+           integer number of gaps, -1 if no window of window_size can satisfy gap_constraint
+   """
+   allowed = -1
+   for gap_count in range( window_size + 1 ):
+       if meets_gap_constraint( gap_count, window_size, gap_constraint ):
+           allowed = gap_count
+       else:
+           break
+   return allowed
+
+def window_validity_mask( sequence, window_size, step_size, gap_constraint ):
+   """
+       Determines, for every window sequence[ start: start + window_size ] with start
+       in range( 0, len( sequence ), step_size ), whether is_valid_sequence would
+       find that window valid. Windows that run past the end of sequence are not valid.
+
+       Gap and 'X' counts of each window are taken from cumulative counts of those
+       characters, so no window is scanned individually. The cumulative counts are only
+       taken over WINDOW_MASK_BLOCK starts at a time, so besides the mask itself, one
+       byte per start, they never take more than a block's worth of memory.
+       sequence may be a str, or a bytes-like row of an Alignment.
+
+       Returns:
+           a bytearray holding 1 for each valid window start, and 0 for every other
+   """
+   sequence_len = len( sequence )
+   num_starts = len( range( 0, sequence_len, step_size ) )
+   num_full = len( range( 0, sequence_len - window_size + 1, step_size ) )
+   max_gaps = max_gaps_allowed( window_size, gap_constraint )
+
+   mask = bytearray( num_starts )
+   if max_gaps < 0:
+       return mask
+
+   for first_start in range( 0, num_full, WINDOW_MASK_BLOCK ):
+       num_block = min( WINDOW_MASK_BLOCK, num_full - first_start )
+       offset = first_start * step_size
+       block = as_bytes( sequence[ offset: offset + ( num_block - 1 ) * step_size + window_size ] )
+
+       gaps_before = array( 'l', accumulate( block.translate( GAP_FLAGS ), initial = 0 ) )
+       xs_before = array( 'l', accumulate( block.translate( X_FLAGS ), initial = 0 ) )
+
+       window_gaps = map( sub, gaps_before[ window_size::step_size ], gaps_before[ :num_block * step_size:step_size ] )
+       window_xs = map( sub, xs_before[ window_size::step_size ], xs_before[ :num_block * step_size:step_size ] )
+
+       mask[ first_start: first_start + num_block ] = bytes( map( and_, map( max_gaps.__ge__, window_gaps ),
+                                                                  map( not_, window_xs )
+                                                                )
+                                                           )
+   return mask
+
+class ColumnProfile:
+    """
+        Per column counts of an alignment: how many sequences have a gap, how many
+        an 'X', and how many distinct residues are found in each column. Positions
+        past the end of a sequence shorter than the alignment count as gaps.
+
+        A column where every sequence has a gap or an 'X' is dead: any sequence with
+        a valid window over it has a gap there. A window start whose window covers
+        more dead columns than a window may have gaps cannot give any sequence a
+        valid window when windows do not span gaps, so window_starts can mark it
+        to be skipped before any sequence is windowed.
+    """
+    def __init__( self, num_sequences, min_length, gap_counts, x_counts, diversity ):
+        self.num_sequences = num_sequences
+        self.min_length = min_length
+        self.gap_counts = gap_counts
+        self.x_counts = x_counts
+        self.diversity = diversity
+
+    @classmethod
+    def from_sequences( cls, sequences ):
+        """
+            Builds the profile of sequences, a list of str or bytes-like sequences,
+            an Alignment, or any iterable of ( name, sequence ) records.
+
+            Sequences are read one at a time, so only the counts, one entry per
+            column, are held. The gap and 'X' flags of up to BYTE_LANE_LIMIT sequences
+            are summed in the byte lanes of an int before being added to the running
+            counts, and the columns each residue is found in are kept as the set
+            byte lanes of one int per residue.
+        """
+        if isinstance( sequences, Alignment ):
+            rows = ( sequences.row( position ) for position in range( len( sequences ) ) )
+        else:
+            rows = ( sequence[ 1 ] if isinstance( sequence, tuple ) else sequence for sequence in sequences )
+
+        gap_counts = array( 'l' )
+        x_counts = array( 'l' )
+        residue_columns = {}
+        length_counts = {}
+        num_sequences = width = 0
+        pending = pending_gaps = pending_xs = 0
+
+        for row in rows:
+            row = as_bytes( row )
+            num_sequences += 1
+            length_counts[ len( row ) ] = length_counts.get( len( row ), 0 ) + 1
+            width = max( width, len( row ) )
+
+            pending_gaps += int.from_bytes( row.translate( GAP_FLAGS ), 'little' )
+            pending_xs += int.from_bytes( row.translate( X_FLAGS ), 'little' )
+            for residue in set( row ) - NOT_RESIDUES:
+                residue_columns[ residue ] = residue_columns.get( residue, 0 ) | \
+                                             int.from_bytes( row.translate( RESIDUE_FLAGS[ residue ] ), 'little' )
+
+            pending += 1
+            if pending == BYTE_LANE_LIMIT:
+                gap_counts = add_byte_lanes( gap_counts, pending_gaps, width )
+                x_counts = add_byte_lanes( x_counts, pending_xs, width )
+                pending = pending_gaps = pending_xs = 0
+
+        gap_counts = add_byte_lanes( gap_counts, pending_gaps, width )
+        x_counts = add_byte_lanes( x_counts, pending_xs, width )
+
+        # Every column past the end of a shorter sequence is a gap of that sequence
+        shorter = array( 'l', [ 0 ] ) * ( width + 1 )
+        for length, count in length_counts.items():
+            shorter[ length ] += count
+        gap_counts = array( 'l', map( add, gap_counts, accumulate( shorter[ :width ] ) ) )
+
+        # A residue's lanes are 0 or 1, and at most 254 residues can be found in a column
+        diversity = add_byte_lanes( array( 'l' ), sum( residue_columns.values() ), width )
+
+        return cls( num_sequences, min( length_counts, default = 0 ), gap_counts, x_counts, diversity )
+
+    def __len__( self ):
+        return len( self.gap_counts )
+
+    def dead_columns( self ):
+        """
+            Returns a bytes object holding 1 for each dead column, and 0 for every other
+        """
+        return bytes( int( gaps + xs == self.num_sequences ) for gaps, xs in zip( self.gap_counts, self.x_counts ) )
+
+    def window_starts( self, window_size, step_size, gap_constraint, span_gaps ):
+        """
+            Finds which of the window starts subset_lists_iter visits may give a valid
+            window for at least one sequence of the alignment. Only windows that do not span
+            gaps, and that lie wholly within every sequence, are checked against the
+            dead columns, any other start is kept unless no window can meet gap_constraint.
+
+            Returns:
+                a bytes object holding 1 for each start in range( 0, len( self ), step_size )
+                that is worth visiting, and 0 for each that can be skipped
+        """
+        num_starts = len( range( 0, len( self ), step_size ) )
+        if max_gaps_allowed( window_size, gap_constraint ) < 0:
+            return bytes( num_starts )
+        if span_gaps:
+            return b'\x01' * num_starts
+
+        max_gaps = max_gaps_allowed( window_size, gap_constraint )
+        dead_before = array( 'l', accumulate( self.dead_columns(), initial = 0 ) )
+        starts = bytearray( b'\x01' * num_starts )
+
+        for index, start in enumerate( range( 0, self.min_length - window_size + 1, step_size ) ):
+            if dead_before[ start + window_size ] - dead_before[ start ] > max_gaps:
+                starts[ index ] = 0
+        return bytes( starts )
+
+def add_byte_lanes( counts, lanes, width ):
+    """
+        Adds the counts held one per byte in the int lanes, the first column in
+        the lowest byte, to counts, an array of per column counts
+
+        Returns:
+            a new array of width per column counts
+    """
+    counts.extend( [ 0 ] * ( width - len( counts ) ) )
+    return array( 'l', map( add, counts, lanes.to_bytes( width, 'little' ) ) )
+
 def append_suffix( string, start, end ):
    """
        Appends _start_end to a string
@@ -215,27 +1124,162 @@ def append_suffix( string, start, end ):
    return "%s_%s_%s" % ( string, str( start ), str( end ) ) 
 
 
-def subset_lists_iter( name, sequence, window_size, step_size, span_gaps, gap_constraints = None):
+def subset_lists_iter( name, sequence, window_size, step_size, span_gaps, gap_constraints = None, residue_index = None,
+                       window_starts = None
+                     ):
+    """
+        Collects the windows of iter_windows into lists, see that function
+        for the meaning of the parameters
+
+        Returns:
+            a list of the names of the valid windows of sequence,
+            and a list of the windows themselves
+    """
     new_names = []
     new_seqs = []
 
-    start = 0
-    end = window_size
-    index = 0
+    for window_name, window in iter_windows( name, sequence, window_size, step_size, span_gaps,
+                                             gap_constraints, residue_index, window_starts
+                                           ):
+        new_names.append( window_name )
+        new_seqs.append( window )
+
+    return new_names, new_seqs
+
+def iter_windows( name, sequence, window_size, step_size, span_gaps, gap_constraint = None, residue_index = None,
+                  window_starts = None
+                ):
+    """
+        Generates the valid windows of sequence, one window start at a time.
 
-    while start < len( sequence ):
-       xmer = grab_xmer_from_seq( sequence, start, window_size, span_gaps )
+        When windows span gaps, they are cut from a copy of sequence without its gaps,
+        so only whether each holds an 'X' needs checking as it is cut. Otherwise the
+        validity of every window start is found at once by window_validity_mask, and
+        only windows shifted back from the end of sequence are checked as they are cut.
 
-       if len( xmer ) == window_size and is_valid_sequence( xmer, gap_constraints ):
+        Params:
+            name- name of sequence, to which _start_end of each window is appended
+            span_gaps- True if windows are cut from sequence with its gaps skipped,
+                       False if each window is the span of sequence it starts at
+            gap_constraint- None, a float percent valid, or an integer minimum
+                            length, as taken by meets_gap_constraint
+            residue_index- the ResidueIndex of sequence, if build_residue_index
+                           has already been called on it
+            window_starts- optional mask of the starts to visit, as created
+                           by ColumnProfile.window_starts
+        Returns:
+            a generator of ( name, window ) tuples, with the gaps
+            of each window removed
+    """
+    if residue_index is None:
+        residue_index = build_residue_index( sequence )
+
+    # Windows are cut from the ungapped sequence when spanning gaps,
+    # so the validity of each is checked at its offset into that
+    source = residue_index.ungapped if span_gaps else sequence
+    max_gaps = max_gaps_allowed( window_size, gap_constraint )
+    valid_starts = None if span_gaps else window_validity_mask( sequence, window_size, step_size, gap_constraint )
+
+    for start in range( 0, len( sequence ), step_size ):
+       # Starts a ColumnProfile found no sequence can have a valid window at are skipped
+       if window_starts is not None and not window_starts[ start // step_size ]:
+           continue
+
+       location = locate_xmer( sequence, residue_index, start, window_size, span_gaps )
+
+       if location is None:
+           xmer = grab_xmer_from_seq( sequence, start, window_size, span_gaps )
+           is_valid = len( xmer ) == window_size and is_valid_sequence( xmer, gap_constraint )
+       else:
+           first, length = location
+           end = first + window_size
+           if span_gaps:
+               is_valid = length == window_size and max_gaps >= 0 and source.find( 'X', first, end ) < 0
+           elif first == start:
+               is_valid = valid_starts[ start // step_size ]
+           else:
+               is_valid = length == window_size and source.find( 'X', first, end ) < 0 and \
+                          source.count( '-', first, end ) <= max_gaps
+           if is_valid:
+               xmer = source[ first: end ]
+
+       if is_valid:
            xmer = xmer.replace( '-', '' )
 
            if xmer:
-               new_seqs.append( xmer )
-               new_names.append( append_suffix( name, start + 1, end ) )
-       start += step_size
-       end = start + window_size 
+               yield append_suffix( name, start + 1, start + window_size ), xmer
 
-    return new_names, new_seqs
+def build_residue_index( sequence ):
+    """
+        Builds the ResidueIndex of sequence, the map from its gapped
+        to its ungapped coordinates
+    """
+    return ResidueIndex( sequence )
+
+class ResidueIndex:
+    """
+        Maps positions of a gapped sequence to positions of the sequence without its
+        gaps, so that the residues of any window can be found with a single slice.
+
+        Rather than an array of the residues before every position, only the count at the
+        last position asked about is kept, and the count at the next position is found by
+        counting the gaps in between. Windows are visited in order, so this stays cheap.
+    """
+    def __init__( self, sequence ):
+        self.sequence = sequence
+        self.ungapped = sequence.replace( '-', '' )
+        self.position = 0
+        self.residues = 0
+
+    def residues_before( self, position ):
+        """
+            Returns the number of residues found before position of the sequence
+        """
+        if position >= self.position:
+            self.residues += ( position - self.position ) - self.sequence.count( '-', self.position, position )
+        else:
+            self.residues -= ( self.position - position ) - self.sequence.count( '-', position, self.position )
+        self.position = position
+        return self.residues
+
+def locate_xmer( sequence, residue_index, start, window_size, span_gaps ):
+    """
+        Finds where the xmer grab_xmer_from_seq would produce for start lies,
+        in the ungapped sequence if span_gaps, otherwise in sequence itself
+
+        Returns:
+            the offset and length of the xmer, or None when the window is shifted back past
+            the first position of sequence, in which case grab_xmer_from_seq
+            wraps around to the end of the sequence
+    """
+    ungapped = residue_index.ungapped
+    sequence_len = len( sequence )
+
+    if span_gaps:
+        kmer_length = len( ungapped ) - residue_index.residues_before( start )
+    else:
+        kmer_length = sequence_len - start
+
+    probe_index = start
+    if ( start + window_size ) >= sequence_len and kmer_length < window_size:
+        probe_index = max( start - ( window_size - kmer_length ), -1 )
+
+    if probe_index < 0:
+        return None
+
+    if not span_gaps:
+        return probe_index, min( window_size, sequence_len - probe_index )
+
+    first = residue_index.residues_before( probe_index )
+    length = min( window_size, len( ungapped ) - first )
+
+    # grab_xmer_from_seq does not include a final residue that it
+    # reaches by skipping over gaps
+    if length and first + length == len( ungapped ) and probe_index < sequence_len - 1 \
+       and sequence[ -1 ] != '-' and sequence[ -2 ] == '-':
+        length -= 1
+
+    return first, length
 
 def grab_xmer_from_seq( sequence, start, window_size, span_gaps ):
    out_xmer = ""
@@ -295,45 +1339,857 @@ def get_kmers_from_seqs(
                         window_size,
                         step_size,
                         span_gaps,
-                        gap_constraint = None
+                        gap_constraint = None,
+                        processes = 1
     ):
 
-   total_kmers = 0
+   if len( names ) > 0:
+       records = zip( names, sequences )
+   else:
+       records = ( ( "", sequence ) for sequence in sequences )
 
-   subset_names = list()
-   subset_seqs = list()
+   return get_kmers_from_records( records, window_size, step_size,
+                                  span_gaps, gap_constraint, processes
+                                )
 
-   for index in range( len( sequences ) ):
 
-      current_sequence = sequences[ index ]
+def get_kmers_from_records( records, window_size, step_size, span_gaps, gap_constraint = None, processes = 1 ):
+   """
+       Creates the unique kmers of each record in records, as get_kmers_from_seqs,
+       but consumes records one at a time so that records may be a generator,
+       such as that returned by iter_fasta
 
-      if len( names ) > 0:
-          current_name = names[ index ]
-      else:
-          current_name = ""
+       Params:
+           records- iterable of ( name, sequence ) tuples
+           processes- number of processes to split the records between. Output
+                      does not depend on the number of processes used
+       Returns:
+           a list of names of the unique kmers, a list of the unique kmers,
+           and the sum over records of the number of unique kmers in each record
+   """
+   if processes > 1:
+       kmer_table = build_kmer_table_parallel( records, window_size, step_size,
+                                               span_gaps, gap_constraint, processes
+                                             )
+   else:
+       kmer_table = build_kmer_table( records, window_size, step_size, span_gaps, gap_constraint )
+
+   subset_names, subset_seqs = kmer_table.get_lists()
+
+   return subset_names, subset_seqs, kmer_table.total_kmers
+
+
+def build_kmer_table( records, window_size, step_size, span_gaps, gap_constraint = None, first_index = 0 ):
+   """
+       Builds a KmerTable of the kmers in records
+
+       Params:
+           first_index- index of the first of records in the whole alignment,
+                        used to name the kmers
+   """
+   kmer_table = KmerTable()
+
+   for index, record in enumerate( records, first_index ):
+      current_name, current_sequence = record
 
       win_names, current_kmers = subset_lists_iter( current_name, current_sequence,
                                                     window_size, step_size,
                                                     span_gaps,
                                                     gap_constraint
                                                   )
-      
-      total_kmers += len( set( current_kmers ) )
+      kmer_table.add_windows( win_names, current_kmers, "_%d_%d" % ( index, index + window_size ) )
+
+   return kmer_table
+
+
+def get_design_from_records( records, window_size, step_size, xmer_size,
+                             span_gaps, gap_constraint = None, processes = 1,
+                             stats = None, covered_codes = None, window_starts = None,
+                             collect_xmers = True
+                           ):
+   """
+       Makes a single pass over records to find both the unique ymers of the design
+       and the xmers used to report on it. Each sequence's residue index is
+       built once and shared by its ymer and xmer windows.
+
+       Params:
+           records- iterable of ( name, sequence ) tuples
+           window_size- size of the ymers to design
+           xmer_size- size of the xmers used to evaluate the design
+           processes- number of processes to split the records between
+           stats- optional StageStats, to which the time spent reading records,
+                  cutting ymers, and cutting xmers is added
+           covered_codes- optional sorted container of the codes of xmers already
+                          covered by an existing library, such as a KmerIndex or the codes
+                          loaded from one. Ymers whose xmers are all covered are left out of
+                          the design, though they are still counted in its total_kmers.
+                          A KmerIndex is reopened by each worker process, rather than copied
+           window_starts- optional mask of the ymer window starts worth visiting,
+                          as created by ColumnProfile.window_starts
+           collect_xmers- False to leave both containers of xmer codes empty, for
+                          when the xmers are only needed for a RedundancySketch
+       Returns:
+           a KmerTable of the ymers, as get_kmers_from_records would create,
+           a sorted container of the codes of the unique xmers of those ymers, and
+           a sorted container of the codes of the unique xmers of records
+   """
+   arguments = ( window_size, step_size, xmer_size, span_gaps, gap_constraint, covered_codes, window_starts,
+                 collect_xmers
+               )
+
+   if stats is None:
+       stats = StageStats()
+
+   if processes <= 1:
+       return build_design_tables( records, *arguments, stats = stats )
 
-      for each in set( current_kmers ):
-         subset_seqs.append( each )
-         subset_names.append( win_names[ current_kmers.index( each ) ] + "_" + str( index ) + "_" + str( index + window_size )   )
+   kmer_table = KmerTable()
+   ymer_xmers = KmerCodeSet( xmer_size )
+   alignment_xmers = KmerCodeSet( xmer_size )
+   pending = deque()
 
+   def merge_shard( future ):
+       shard_table, shard_ymer_xmers, shard_alignment_xmers, shard_stats = future.result()
+       kmer_table.merge( shard_table )
+       ymer_xmers.add_codes( shard_ymer_xmers )
+       alignment_xmers.add_codes( shard_alignment_xmers )
+       stats.merge( shard_stats )
 
-   subset_names, subset_seqs = get_unique_sequences( subset_names, subset_seqs )
+   with ProcessPoolExecutor( processes ) as executor:
+       for first_index, shard in iter_shards( stats.iter_stage( 'parse', records ), KMER_SHARD_SIZE ):
+           pending.append( executor.submit( build_design_shard, shard, *arguments,
+                                            first_index = first_index
+                                          )
+                         )
+           if len( pending ) >= 2 * processes:
+               merge_shard( pending.popleft() )
 
-   return subset_names, subset_seqs, total_kmers
+       while pending:
+           merge_shard( pending.popleft() )
 
+   return kmer_table, ymer_xmers.get_codes(), alignment_xmers.get_codes()
+
+
+def build_design_shard( records, *arguments, first_index = 0 ):
+   """
+       Runs build_design_tables on a shard of records in a worker process
+
+       Returns:
+           the results of build_design_tables, followed by the
+           StageStats of the shard
+   """
+   stats = StageStats()
+   results = build_design_tables( records, *arguments, first_index = first_index, stats = stats )
+
+   # Records were read by the parent process, which times that itself
+   stats.stages.pop( 'parse', None )
+   return results + ( stats, )
+
+
+def build_design_tables( records, window_size, step_size, xmer_size,
+                         span_gaps, gap_constraint = None, covered_codes = None,
+                         window_starts = None, collect_xmers = True, first_index = 0,
+                         stats = None
+                       ):
+   """
+       Serial implementation of get_design_from_records, see that
+       function for the meaning of the parameters and return values
+   """
+   kmer_table = KmerTable()
+   ymer_xmers = KmerCodeSet( xmer_size )
+   alignment_xmers = KmerCodeSet( xmer_size )
+   covered_ymers = set()
+
+   if stats is None:
+       stats = StageStats()
+
+   for index, record in enumerate( stats.iter_stage( 'parse', records ), first_index ):
+      current_name, current_sequence = record
+
+      suffix = "_%d_%d" % ( index, index + window_size )
+      residue_index = build_residue_index( current_sequence )
+
+      # Windows are consumed as they are cut. Only the ymers seen in this sequence are
+      # kept, as a ymer is named after its first window in the latest sequence it is found in
+      with stats.stage( 'ymer_windows' ) as stage:
+          sequence_ymers = set()
+
+          for window_name, ymer in iter_windows( current_name, current_sequence,
+                                                 window_size, step_size,
+                                                 span_gaps,
+                                                 gap_constraint,
+                                                 residue_index,
+                                                 window_starts
+                                               ):
+              stage.add_items( 1 )
+              if ymer in sequence_ymers:
+                  continue
+              sequence_ymers.add( ymer )
+
+              # The xmers of a ymer only need finding the first time it is seen
+              if ymer not in kmer_table.kmers and ymer not in covered_ymers and \
+                 ( covered_codes is not None or collect_xmers ):
+                  xmer_codes = set( map( encode_kmer, get_xmers_of_ymer( ymer, xmer_size, span_gaps ) ) )
+                  if covered_codes is not None and \
+                     all( contains_code( covered_codes, code ) for code in xmer_codes ):
+                      covered_ymers.add( ymer )
+                  elif collect_xmers:
+                      ymer_xmers.add_codes( xmer_codes )
+
+              if ymer not in covered_ymers:
+                  kmer_table.kmers[ ymer ] = window_name + suffix
+
+          kmer_table.total_kmers += len( sequence_ymers )
+
+      if collect_xmers:
+          with stats.stage( 'xmer_windows' ) as stage:
+              alignment_windows = iter_windows( "", current_sequence, xmer_size, 1,
+                                                span_gaps, None, residue_index
+                                              )
+              stage.add_items( alignment_xmers.add_codes( encode_kmer( xmer ) for xmer_name, xmer in alignment_windows ) )
+
+   return kmer_table, ymer_xmers.get_codes(), alignment_xmers.get_codes()
+
+
+def get_xmers_of_ymer( ymer, xmer_size, span_gaps ):
+   """
+       Finds the xmers subset_lists_iter would cut from ymer with a step size of 1.
+       Ymers contain neither gaps nor 'X' characters, so when ymer is at least
+       xmer_size long these are simply its substrings of xmer_size
+   """
+   if len( ymer ) < xmer_size:
+       return subset_lists_iter( "", ymer, xmer_size, 1, span_gaps )[ 1 ]
+   return [ ymer[ start: start + xmer_size ] for start in range( len( ymer ) - xmer_size + 1 ) ]
+
+
+def greedy_cover( kmer_table, xmer_size, span_gaps, covered_codes = None ):
+   """
+       Chooses a small set of the ymers of kmer_table that together cover every xmer
+       found in any of them, by repeatedly choosing the ymer that covers the most
+       xmers not yet covered. Ties go to the ymer added to the table first.
+
+       An inverted index maps each uncovered xmer to the ymers containing it, so when
+       a ymer is chosen, the gain of every ymer sharing one of its xmers is updated
+       directly. The max-heap of gains is updated lazily: an entry whose gain has fallen
+       since it was pushed is pushed again with its new gain when it is popped.
+
+       Params:
+           kmer_table- KmerTable of the candidate ymers
+           covered_codes- optional sorted container of the codes of xmers already
+                          covered, which choosing a ymer gains nothing for
+       Returns:
+           a KmerTable of the chosen ymers, in the order of kmer_table and with
+           the same names and total_kmers, and a sorted container of the
+           codes of the unique xmers of the chosen ymers
+   """
+   candidates = list( kmer_table.kmers )
+   candidate_codes = []
+   inverted_index = {}
+
+   for position, ymer in enumerate( candidates ):
+       codes = tuple( set( map( encode_kmer, get_xmers_of_ymer( ymer, xmer_size, span_gaps ) ) ) )
+       if covered_codes is not None:
+           codes = tuple( code for code in codes if not contains_code( covered_codes, code ) )
+       candidate_codes.append( codes )
+       for code in codes:
+           inverted_index.setdefault( code, [] ).append( position )
+
+   gains = array( 'l', map( len, candidate_codes ) )
+   heap = [ ( -gain, position ) for position, gain in enumerate( gains ) if gain ]
+   heapify( heap )
+   chosen = []
+
+   while heap:
+       negative_gain, position = heappop( heap )
+       if -negative_gain != gains[ position ]:
+           if gains[ position ]:
+               heappush( heap, ( -gains[ position ], position ) )
+           continue
+
+       chosen.append( position )
+       for code in candidate_codes[ position ]:
+           # Xmers leave the index once covered, so each is only counted against once
+           for other in inverted_index.pop( code, () ):
+               gains[ other ] -= 1
+
+   cover_table = KmerTable()
+   cover_table.total_kmers = kmer_table.total_kmers
+   cover_xmers = KmerCodeSet( xmer_size )
+
+   for position in sorted( chosen ):
+       ymer = candidates[ position ]
+       cover_table.kmers[ ymer ] = kmer_table.kmers[ ymer ]
+       cover_xmers.add_kmers( get_xmers_of_ymer( ymer, xmer_size, span_gaps ) )
+
+   return cover_table, cover_xmers.get_codes()
+
+
+def build_kmer_table_parallel( records, window_size, step_size, span_gaps, gap_constraint, processes ):
+   """
+       Builds the same KmerTable as build_kmer_table, splitting records into shards
+       of KMER_SHARD_SIZE consecutive records that are processed by a pool of processes.
+
+       Shard tables are merged in the order of the records, so names are
+       the same as those build_kmer_table would give. Only a few shards per
+       process are read ahead of the merge, so records may be a generator.
+   """
+   kmer_table = KmerTable()
+   pending = deque()
+
+   with ProcessPoolExecutor( processes ) as executor:
+       for first_index, shard in iter_shards( records, KMER_SHARD_SIZE ):
+           pending.append( executor.submit( build_kmer_table, shard, window_size, step_size,
+                                            span_gaps, gap_constraint, first_index
+                                          )
+                         )
+           if len( pending ) >= 2 * processes:
+               kmer_table.merge( pending.popleft().result() )
+
+       while pending:
+           kmer_table.merge( pending.popleft().result() )
+
+   return kmer_table
+
+
+def iter_shards( records, shard_size ):
+   """
+       Splits records into lists of shard_size consecutive records
+
+       Returns:
+           a generator of ( index of first record, list of records ) tuples
+   """
+   shard = []
+   first_index = 0
+
+   for record in records:
+       shard.append( record )
+       if len( shard ) == shard_size:
+           yield first_index, shard
+           first_index += shard_size
+           shard = []
+
+   if shard:
+       yield first_index, shard
+
+
+class KmerTable:
+    """
+        Table of unique kmers, built one sequence at a time, that records
+        the name of the window each kmer was taken from.
+
+        Within a sequence, a kmer is named after the first window it was
+        found in. When a kmer is found in more than one sequence, it keeps
+        its place in the table, but takes its name from the latest sequence.
+    """
+    def __init__( self ):
+        self.kmers = {}
+        self.total_kmers = 0
+
+    def __len__( self ):
+        return len( self.kmers )
+
+    def add_windows( self, win_names, kmers, suffix = "", exclude = () ):
+        """
+            Adds the windows of a single sequence to the table
+
+            :param win_names: names of each of the windows of the sequence
+            :param kmers: the kmers cut from each window, in window order
+            :param suffix: string appended to the name of each kmer added
+            :param exclude: kmers that are counted in total_kmers,
+                            but are not added to the table
+        """
+        # Later assignments win when building a dict, so build it
+        # back to front to keep the first window of each kmer
+        first_names = dict( zip( reversed( kmers ), reversed( win_names ) ) )
+        self.total_kmers += len( first_names )
+
+        for kmer in dict.fromkeys( kmers ):
+            if kmer not in exclude:
+                self.kmers[ kmer ] = first_names[ kmer ] + suffix
+
+    def merge( self, other ):
+        """
+            Adds the kmers of other, a table of sequences that
+            follow those of this table, to this table
+        """
+        self.kmers.update( other.kmers )
+        self.total_kmers += other.total_kmers
+
+    def iter_records( self ):
+        """
+            Returns a generator of the ( name, kmer ) records of the table,
+            in the order they were first added
+        """
+        return ( ( name, kmer ) for kmer, name in self.kmers.items() )
+
+    def get_lists( self ):
+        """
+            Returns a list of the names of the kmers in the table and
+            a list of the kmers, in the order they were first added
+        """
+        return list( self.kmers.values() ), list( self.kmers.keys() )
+
+
+def encode_kmer( kmer ):
+   """
+       Encodes kmer as an integer, KMER_CODE_BITS bits per residue. A character
+       not in KMER_ALPHABET is escaped, see encode_escaped_kmer
+   """
+   code = 0
+   try:
+       for residue in kmer:
+           code = ( code << KMER_CODE_BITS ) | KMER_CODES[ residue ]
+   except KeyError:
+       return encode_escaped_kmer( kmer )
+   return code
+
+def encode_escaped_kmer( kmer ):
+   """
+       Encodes kmer as encode_kmer does, except that each character not in KMER_ALPHABET
+       is encoded as KMER_ESCAPE followed by its code point in KMER_ESCAPE_BITS bits.
+       No code of KMER_ALPHABET is KMER_ESCAPE, so codes remain unique
+   """
+   code = 0
+   for residue in kmer:
+       if residue in KMER_CODES:
+           code = ( code << KMER_CODE_BITS ) | KMER_CODES[ residue ]
+       else:
+           code = ( ( ( code << KMER_CODE_BITS ) | KMER_ESCAPE ) << KMER_ESCAPE_BITS ) | ord( residue )
+   return code
+
+def new_code_array( xmer_size ):
+   """
+       Creates an empty container for the codes of kmers of xmer_size,
+       8 bytes per code when they fit into 64 bits
+   """
+   if xmer_size <= MAX_ENCODED_KMER:
+       return array( 'Q' )
+   return list()
+
+def merge_codes( codes, new_codes, xmer_size ):
+   """
+       Merges new_codes, which need be neither sorted nor unique, into the sorted, unique codes.
+       Only new_codes are sorted, the runs of codes between them are copied
+       across in slices, so codes are never turned into Python integers
+
+       Returns:
+           a new sorted container of the unique codes found in either, a list
+           if either codes or new_codes is, as they may hold codes wider than 64 bits
+   """
+   if isinstance( codes, list ) or isinstance( new_codes, list ):
+       merged = list()
+   else:
+       merged = new_code_array( xmer_size )
+   previous = 0
+   last = None
+
+   for code in sorted( new_codes ):
+       if code == last:
+           continue
+       last = code
+
+       position = bisect_left( codes, code, previous )
+       merged.extend( codes[ previous: position ] )
+       previous = position
+       if position == len( codes ) or codes[ position ] != code:
+           merged.append( code )
+
+   merged.extend( codes[ previous: ] )
+   return merged
+
+def get_xmer_codes_from_records( records, xmer_size, span_gaps ):
+   """
+       Finds the encoded unique xmers of records, the same xmers that
+       get_kmers_from_records would find with a step size of 1 and no gap constraint,
+       without keeping the string of any xmer once its record has been processed
+
+       Params:
+           records- iterable of ( name, sequence ) tuples
+       Returns:
+           a sorted container of the unique codes of the xmers in records
+   """
+   xmer_codes = KmerCodeSet( xmer_size )
+
+   for name, sequence in records:
+       xmer_codes.add_kmers( xmer for xmer_name, xmer in iter_windows( name, sequence, xmer_size, 1, span_gaps ) )
+
+   return xmer_codes.get_codes()
+
+class KmerCodeSet:
+    """
+        Set of encoded kmers of at most xmer_size residues, kept as a sorted container
+        of unique codes. New codes are buffered, and only merged into the
+        sorted codes once KMER_CODE_BUFFER_SIZE of them have been added.
+
+        Codes of kmers with escaped characters may not fit into the 64 bits of an
+        array( 'Q' ). These are kept in a separate set, and only when there are any
+        does get_codes return a list, with them after every other code.
+    """
+    def __init__( self, xmer_size ):
+        self.xmer_size = xmer_size
+        self.codes = new_code_array( xmer_size )
+        self.buffer = new_code_array( xmer_size )
+        self.wide_codes = set()
+        self.num_wide = 0
+
+    def add_kmers( self, kmers ):
+        """
+            Encodes and adds each of kmers to the set
+        """
+        self.add_codes( map( encode_kmer, dict.fromkeys( kmers ) ) )
+
+    def add_codes( self, codes ):
+        """
+            Adds each of codes, which may be a generator, to the set. The buffer is
+            filled and merged in turn, so it never holds more than KMER_CODE_BUFFER_SIZE codes
+
+            Returns:
+                the number of codes added
+        """
+        codes = iter( codes )
+        if isinstance( self.buffer, array ):
+            codes = self._divert_wide_codes( codes )
+
+        num_wide = self.num_wide
+        added = 0
+        while True:
+            room = KMER_CODE_BUFFER_SIZE - len( self.buffer )
+            filled = len( self.buffer )
+            self.buffer.extend( islice( codes, room ) )
+            filled = len( self.buffer ) - filled
+            added += filled
+
+            if len( self.buffer ) >= KMER_CODE_BUFFER_SIZE:
+                self._flush()
+            if filled < room:
+                return added + self.num_wide - num_wide
+
+    def _divert_wide_codes( self, codes ):
+        for code in codes:
+            if code > HASH_MASK:
+                self.wide_codes.add( code )
+                self.num_wide += 1
+            else:
+                yield code
+
+    def merge( self, other ):
+        self.add_codes( other.get_codes() )
+
+    def get_codes( self ):
+        """
+            Returns the sorted container of the unique codes in the set
+        """
+        if self.buffer:
+            self._flush()
+        if self.wide_codes:
+            # Every wide code is larger than any code that fits into 64 bits
+            return list( self.codes ) + sorted( self.wide_codes )
+        return self.codes
+
+    def _flush( self ):
+        self.codes = merge_codes( self.codes, self.buffer, self.xmer_size )
+        self.buffer = new_code_array( self.xmer_size )
+
+def count_shared_codes( query_codes, reference_codes ):
+   """
+       Counts how many of the sorted, unique query_codes are found in the
+       sorted, unique reference_codes
+   """
+   if len( query_codes ) > len( reference_codes ):
+       query_codes, reference_codes = reference_codes, query_codes
+
+   shared = 0
+   reference_len = len( reference_codes )
+   for code in query_codes:
+       position = bisect_left( reference_codes, code )
+       if position < reference_len and reference_codes[ position ] == code:
+           shared += 1
+   return shared
+
+
+def contains_code( codes, code ):
+   """
+       Returns True if code is found in the sorted container codes
+   """
+   position = bisect_left( codes, code )
+   return position < len( codes ) and codes[ position ] == code
+
+def kmer_index_width( xmer_size ):
+   """
+       Returns the number of bytes each code of a kmer index of xmer_size takes
+   """
+   if xmer_size <= MAX_ENCODED_KMER:
+       return 8
+   return ( xmer_size * KMER_CODE_BITS + 7 ) // 8
+
+def write_kmer_index( index_name, codes, xmer_size ):
+   """
+       Writes the sorted, unique codes of kmers of at most xmer_size to index_name.
+       The index is written to a temporary file that then replaces index_name,
+       so an index may be rewritten while it is open.
+
+       Codes of kmers with escaped characters that are too wide for the index are
+       left out, so the index never covers those kmers, and ymers holding them
+       are always designed again
+
+       Returns:
+           the number of codes written
+   """
+   width = kmer_index_width( xmer_size )
+   temp_name = index_name + ".tmp%d" % os.getpid()
+
+   # The codes too wide to write are the largest, at the end of codes
+   if not isinstance( codes, array ):
+       codes = codes[ :bisect_left( codes, 1 << ( 8 * width ) ) ]
+
+   with open( temp_name, 'wb' ) as out_file:
+       out_file.write( KMER_INDEX_HEADER.pack( KMER_INDEX_MAGIC, xmer_size, len( codes ) ) )
+       if isinstance( codes, array ):
+           big_endian = array( 'Q', codes )
+           if sys.byteorder == 'little':
+               big_endian.byteswap()
+           big_endian.tofile( out_file )
+       else:
+           for start in range( 0, len( codes ), FASTA_WRITE_BATCH ):
+               out_file.write( b''.join( code.to_bytes( width, 'big' )
+                                         for code in codes[ start: start + FASTA_WRITE_BATCH ]
+                                       )
+                             )
+
+   os.replace( temp_name, index_name )
+   return len( codes )
+
+def build_kmer_index( library_name, xmer_size, index_name = None ):
+   """
+       Builds a kmer index of the xmers covered by the ymers of a finished
+       library, written to index_name when it is given
+
+       Returns:
+           an open KmerIndex of the library, if index_name is given,
+           otherwise the sorted container of the codes that it would hold
+   """
+   records = open_fasta_records( library_name )
+   codes = get_xmer_codes_from_records( records, xmer_size, True )
+   records.close()
+
+   if index_name is None:
+       return codes
+
+   write_kmer_index( index_name, codes, xmer_size )
+   return KmerIndex( index_name )
+
+class KmerIndex:
+    """
+        Sorted index of the encoded xmers covered by a library, kept on disk so that
+        a later design can leave out the ymers whose xmers the library already covers.
+        Codes are read through a memory map, and may be searched with bisect
+        directly, or loaded into memory with get_codes for faster lookups.
+    """
+    def __init__( self, index_name ):
+        """
+            :param index_name: name of an index written by write_kmer_index
+
+            :raises ValueError: if index_name is not a kmer index
+        """
+        self.index_name = index_name
+        self._file = open( index_name, 'rb' )
+
+        header = self._file.read( KMER_INDEX_HEADER.size )
+        if len( header ) < KMER_INDEX_HEADER.size or header[ :len( KMER_INDEX_MAGIC ) ] != KMER_INDEX_MAGIC:
+            self._file.close()
+            raise ValueError( "%s is not a kmer index" % index_name )
+
+        magic, self.xmer_size, self.num_codes = KMER_INDEX_HEADER.unpack( header )
+        self.width = kmer_index_width( self.xmer_size )
+
+        if self.num_codes:
+            self._map = mmap.mmap( self._file.fileno(), 0, access = mmap.ACCESS_READ )
+        else:
+            self._map = b''
+
+    def __len__( self ):
+        return self.num_codes
+
+    def __getitem__( self, position ):
+        if not 0 <= position < self.num_codes:
+            raise IndexError( "kmer index position out of range" )
+        start = KMER_INDEX_HEADER.size + position * self.width
+        return int.from_bytes( self._map[ start: start + self.width ], 'big' )
+
+    def __contains__( self, kmer ):
+        """
+            Returns True if kmer, a string or the code of one, is in the index
+        """
+        code = encode_kmer( kmer ) if isinstance( kmer, str ) else kmer
+        return contains_code( self, code )
+
+    def get_codes( self ):
+        """
+            Returns the codes of the index, in a sorted container
+            of the type KmerCodeSet would create
+        """
+        codes = new_code_array( self.xmer_size )
+        data = self._map[ KMER_INDEX_HEADER.size: ]
+
+        if isinstance( codes, array ):
+            codes.frombytes( data )
+            if sys.byteorder == 'little':
+                codes.byteswap()
+        else:
+            codes.extend( int.from_bytes( data[ start: start + self.width ], 'big' )
+                          for start in range( 0, len( data ), self.width )
+                        )
+        return codes
+
+    def close( self ):
+        if isinstance( self._map, mmap.mmap ):
+            self._map.close()
+        self._file.close()
+
+    def __reduce__( self ):
+        # Worker processes open the index themselves instead of being sent its codes
+        return KmerIndex, ( self.index_name, )
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        self.close()
+
+def hash_code( code ):
+   """
+       Hashes the code of a kmer to a well mixed 64 bit integer. Codes
+       of more than 64 bits are folded into 64 bits first
+   """
+   while code >> 64:
+       code = ( code & HASH_MASK ) ^ ( code >> 64 )
+   code = ( code + HASH_GOLDEN ) & HASH_MASK
+   code = ( ( code ^ ( code >> 30 ) ) * 0xbf58476d1ce4e5b9 ) & HASH_MASK
+   code = ( ( code ^ ( code >> 27 ) ) * 0x94d049bb133111eb ) & HASH_MASK
+   return code ^ ( code >> 31 )
+
+class HyperLogLog:
+    """
+        Estimates the number of distinct kmer codes added to it, in a fixed
+        2 ** precision bytes, with a relative standard error of about 1.04 / sqrt( 2 ** precision )
+    """
+    def __init__( self, error = 0.01 ):
+        """
+            :param error: largest relative standard error allowed, which sets the precision
+        """
+        self.precision = min( 18, max( 4, math.ceil( math.log2( ( 1.04 / error ) ** 2 ) ) ) )
+        self.registers = bytearray( 1 << self.precision )
+        self.rest_bits = 64 - self.precision
+        self.rest_mask = ( 1 << self.rest_bits ) - 1
+
+    def add( self, code ):
+        hashed = hash_code( code )
+        register = hashed >> self.rest_bits
+        rank = self.rest_bits - ( hashed & self.rest_mask ).bit_length() + 1
+        if rank > self.registers[ register ]:
+            self.registers[ register ] = rank
+
+    def add_codes( self, codes ):
+        registers, rest_bits, rest_mask = self.registers, self.rest_bits, self.rest_mask
+        for code in codes:
+            hashed = hash_code( code )
+            rank = rest_bits - ( hashed & rest_mask ).bit_length() + 1
+            if rank > registers[ hashed >> rest_bits ]:
+                registers[ hashed >> rest_bits ] = rank
+
+    def union( self, other ):
+        """
+            Returns a new HyperLogLog of the codes added to either this or other,
+            which must have the same precision
+        """
+        if other.precision != self.precision:
+            raise ValueError( "Cannot combine HyperLogLogs of different precision" )
+        combined = HyperLogLog.__new__( HyperLogLog )
+        combined.__dict__.update( self.__dict__ )
+        combined.registers = bytearray( map( max, self.registers, other.registers ) )
+        return combined
+
+    def standard_error( self ):
+        return 1.04 / math.sqrt( len( self.registers ) )
+
+    def estimate( self ):
+        """
+            Returns the estimated number of distinct codes added
+        """
+        num_registers = len( self.registers )
+        alpha = 0.7213 / ( 1 + 1.079 / num_registers )
+        estimate = alpha * num_registers * num_registers / math.fsum( 2.0 ** -rank for rank in self.registers )
+
+        # Small counts leave registers empty, and are better estimated by linear counting
+        empty = self.registers.count( 0 )
+        if estimate <= 2.5 * num_registers and empty:
+            estimate = num_registers * math.log( num_registers / float( empty ) )
+        return estimate
+
+class RedundancySketch:
+    """
+        Estimates the redundancy statistics of a design in fixed memory, however large
+        the alignment: HyperLogLogs count the distinct xmers of the ymers and of the alignment.
+
+        Neighbouring ymers, and the aligned sequences, share most of their xmers, so
+        xmers are gathered into a set of at most SKETCH_BATCH_SIZE before being encoded
+        and hashed, and each is only hashed once per batch it is found in.
+    """
+    def __init__( self, xmer_size, span_gaps, error = 0.01 ):
+        """
+            :param error: relative standard error of the HyperLogLogs
+        """
+        self.xmer_size = xmer_size
+        self.span_gaps = span_gaps
+        self.ymer_xmers = HyperLogLog( error )
+        self.alignment_xmers = HyperLogLog( error )
+        self.alignment_windows = 0
+
+    @staticmethod
+    def add_batched( sketch, xmers ):
+        """
+            Adds the code of each distinct xmer of the iterable xmers to sketch, a HyperLogLog
+        """
+        batch = set()
+        for xmer in xmers:
+            batch.add( xmer )
+            if len( batch ) >= SKETCH_BATCH_SIZE:
+                sketch.add_codes( map( encode_kmer, batch ) )
+                batch.clear()
+        sketch.add_codes( map( encode_kmer, batch ) )
+
+    def add_ymers( self, ymers ):
+        self.add_batched( self.ymer_xmers, ( xmer for ymer in ymers
+                                                  for xmer in get_xmers_of_ymer( ymer, self.xmer_size, self.span_gaps )
+                                           )
+                        )
+
+    def add_records( self, records ):
+        self.add_batched( self.alignment_xmers, self.iter_alignment_xmers( records ) )
+
+    def iter_alignment_xmers( self, records ):
+        for name, sequence in records:
+            for xmer_name, xmer in iter_windows( "", sequence, self.xmer_size, 1, self.span_gaps ):
+                self.alignment_windows += 1
+                yield xmer
+
+    def shared_xmers( self ):
+        """
+            Returns the estimated number of distinct xmers found both in the ymers and in the
+            alignment, by inclusion-exclusion, and the error of that estimate at two standard errors
+        """
+        ymer_xmers = self.ymer_xmers.estimate()
+        alignment_xmers = self.alignment_xmers.estimate()
+        union = self.ymer_xmers.union( self.alignment_xmers ).estimate()
+
+        shared = max( 0.0, min( ymer_xmers, alignment_xmers, ymer_xmers + alignment_xmers - union ) )
+        error = 2 * self.ymer_xmers.standard_error() * ( ymer_xmers + alignment_xmers + union )
+        return shared, error
 
 def subset_lists( name, sequence, window_size, step_size ):
    """
-       Creates a list of subsets of windowSize size in intervals of stepSize
-       Note: Uses recursive subset_lists_helper for operations
+       Creates a list of subsets of windowSize size in intervals of stepSize.
+       Only windows that end within sequence are included, and gaps are kept
    
        Params:
             name: String name of sequence to be split up
@@ -344,22 +2200,100 @@ def subset_lists( name, sequence, window_size, step_size ):
    """
    new_names = []
    new_seqs = []
-   return subset_lists_helper( name, sequence, new_names, new_seqs, window_size, step_size, 0, window_size )
 
-def subset_lists_helper( name, sequence, name_arr, seq_arr, window_size, step_size, start, end ):
-    """
-        Recursive helper method called by subset_lists
-    """
-    if start + window_size <= len( sequence ):
-       if len( sequence[ start: end ] ) == 1:
-           return
-       seq_arr.append( sequence[ start : end ] ) 
-       name_arr.append( append_suffix( name, start + 1, end ) )
+   for start in range( 0, len( sequence ) - window_size + 1, step_size ):
+       new_seqs.append( sequence[ start: start + window_size ] )
+       new_names.append( append_suffix( name, start + 1, start + window_size ) )
 
-       subset_lists_helper( name, sequence, name_arr, seq_arr, window_size, step_size, start + step_size, start + step_size + window_size )
-    return name_arr, seq_arr
-   
+   return new_names, new_seqs
 
 
-            
-    
+class StageStats:
+    """
+        Records the wall time, CPU time, peak resident set size, and number
+        of items processed by each named stage of a program. Time spent in a
+        stage is added up over every time the stage is entered.
+    """
+    def __init__( self ):
+        self.stages = {}
+
+    class Stage:
+        def __init__( self ):
+            self.wall_seconds = 0.0
+            self.cpu_seconds = 0.0
+            self.peak_rss_kib = 0
+            self.items = 0
+
+        def add_items( self, count ):
+            self.items += count
+
+        def to_dict( self ):
+            return { 'wall_seconds': self.wall_seconds,
+                     'cpu_seconds': self.cpu_seconds,
+                     'peak_rss_kib': self.peak_rss_kib,
+                     'items': self.items
+                   }
+
+    def get_stage( self, name ):
+        if name not in self.stages:
+            self.stages[ name ] = StageStats.Stage()
+        return self.stages[ name ]
+
+    @contextmanager
+    def stage( self, name ):
+        """
+            Times the body of a with statement as part of stage name,
+            yields the stage so that items can be added to it
+        """
+        current = self.get_stage( name )
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield current
+        finally:
+            current.wall_seconds += time.perf_counter() - wall_start
+            current.cpu_seconds += time.process_time() - cpu_start
+            # ru_maxrss is in KiB on Linux
+            current.peak_rss_kib = max( current.peak_rss_kib,
+                                        resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+                                      )
+
+    def iter_stage( self, name, items ):
+        """
+            Iterates over items, counting the time taken to produce
+            each item as part of stage name
+        """
+        iterator = iter( items )
+        while True:
+            with self.stage( name ) as current:
+                try:
+                    item = next( iterator )
+                except StopIteration:
+                    return
+                current.add_items( 1 )
+            yield item
+
+    def merge( self, other ):
+        """
+            Adds the times and items of the stages of other to this.
+            Peak resident set sizes are the largest of the two
+        """
+        for name, other_stage in other.stages.items():
+            current = self.get_stage( name )
+            current.wall_seconds += other_stage.wall_seconds
+            current.cpu_seconds += other_stage.cpu_seconds
+            current.peak_rss_kib = max( current.peak_rss_kib, other_stage.peak_rss_kib )
+            current.items += other_stage.items
+
+    def to_dict( self ):
+        return { name: current.to_dict() for name, current in self.stages.items() }
+
+    def write_json( self, output_name, **extra ):
+        """
+            Writes the stages to output_name as JSON, along with
+            any extra keyword values given
+        """
+        report = dict( extra )
+        report[ 'stages' ] = self.to_dict()
+        with open( output_name, 'w' ) as out_file:
+            json.dump( report, out_file, indent = 2 )
@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 
 import protein_lib as oligo
+import os
 import sys
 import optparse
+import cProfile
+
+# Stats of a run are written to the output file name with this appended
+STATS_SUFFIX = ".stats.json"
 
 def main():
    usage = "usage: %prog [options]"
@@ -12,67 +17,259 @@ def main():
 
    options, arguments = option_parser.parse_args()
 
+   if options.index_library:
+      if options.library_index is None:
+         print( "An index name must be provided with --library_index to index a library, exiting." )
+         sys.exit( 1 )
+      oligo.build_kmer_index( options.index_library, options.XmerWindowSize, options.library_index ).close()
+      if options.alignment is None and options.batch is None:
+         return
+
+   if options.batch:
+      design_batch( options.batch, options )
+      return
+
    # Make sure that a file was provided to script
    if options.alignment is None:
       print( "Fasta alignment file must be provided, exiting." )
       sys.exit( 1 )
 
-   names, sequences = oligo.read_fasta_lists( options.alignment )
+   design_alignment( options.alignment, options.outPut, options )
+
+
+def design_batch( batch_name, options ):
+   """
+      Designs from each alignment listed in batch_name in turn, within this process.
+      Each line of batch_name holds the name of an alignment and the name of its
+      output file, separated by a tab. Every design uses the rest of options.
+
+      A design that fails does not stop the rest of the batch, but the
+      program exits with status 1 once the batch is done
+   """
+   failures = 0
+
+   with open( batch_name, 'r' ) as batch_file:
+      jobs = [ line.rstrip( '\n' ).split( '\t' ) for line in batch_file if line.strip() ]
 
+   for alignment_name, output_name in jobs:
+      try:
+         design_alignment( alignment_name, output_name, options )
+      except Exception as error:
+         print( "ERROR: design from %s failed: %s" % ( alignment_name, error ) )
+         failures += 1
+
+   if failures:
+      sys.exit( 1 )
+
+
+def design_alignment( alignment_name, output_name, options ):
+   """
+      Designs the oligos of alignment_name, writing them to output_name
+      and printing a summary of the design
+   """
    # Determine what gaps constraints to use, if any
    gap_constraints = options.minLength if options.minLength else options.percentValid
 
-   subset_names = []
-   subset_seqs = []
-   total_ymers = 0
-
    span_gaps = options.dont_span_gaps == None
 
-   subset_names, subset_seqs, total_ymers = oligo.get_kmers_from_seqs( names,
-                                                                       sequences,
-                                                                       options.windowSize,
-                                                                       options.stepSize,
-                                                                       span_gaps,
-                                                                       gap_constraint = gap_constraints
-                                            )
-
-   
-   # create subset xmers from out ymers
-   design_ymer_subset_names, subset_ymers, total_xmers = oligo.get_kmers_from_seqs( "",
-                                                                       subset_seqs,
-                                                                       options.XmerWindowSize,
-                                                                       1,
-                                                                       span_gaps
-                                                                      )
-
-   subset_xmer_names, subset_xmers, total_xmers = oligo.get_kmers_from_seqs( "",
-                                                                             sequences,
-                                                                             options.XmerWindowSize,
-                                                                             1,
-                                                                             span_gaps
-                                                                           )  
-
-   win_xmers_dict = {}
-   for item in subset_xmers:
-        win_xmers_dict[ item ] = 0
-
-   output_names, output_seqs = subset_names, subset_seqs
+   stats = oligo.StageStats()
+
+   with stats.stage( 'open' ):
+      alignment = oligo.open_fasta_records( alignment_name )
+
+   # Ymers of an existing library, and any ymers covered by them, need not be designed again
+   library_index = None
+   covered_codes = None
+   if options.library_index and os.path.exists( options.library_index ):
+      with stats.stage( 'library_index' ) as stage:
+         try:
+            library_index = oligo.KmerIndex( options.library_index )
+         except ValueError as error:
+            print( "%s, exiting." % error )
+            sys.exit( 1 )
+         if library_index.xmer_size != options.XmerWindowSize:
+            print( "Library index %s is of %d-mers, not of the %d-mers given by -x, exiting." %
+                   ( options.library_index, library_index.xmer_size, options.XmerWindowSize )
+                 )
+            library_index.close()
+            sys.exit( 1 )
+         covered_codes = library_index if options.threads > 1 else library_index.get_codes()
+         stage.add_items( len( library_index ) )
+
+   # When windows do not span gaps, columns that are gaps or 'X' in every sequence can rule out
+   # window starts for the whole alignment, which needs a first pass over a re-readable alignment
+   window_starts = None
+   if not span_gaps and isinstance( alignment, oligo.IndexedFasta ):
+      with stats.stage( 'column_profile' ) as stage:
+         column_profile = oligo.ColumnProfile.from_sequences( alignment )
+         window_starts = column_profile.window_starts( options.windowSize, options.stepSize,
+                                                       gap_constraints, span_gaps
+                                                     )
+         stage.add_items( len( column_profile ) )
+
+   if options.profile:
+      profiler = cProfile.Profile()
+      profiler.enable()
+
+   # Find the ymers of the design, along with the encoded xmers of those
+   # ymers and of the whole alignment, in a single pass over the alignment
+   ymer_table, ymer_xmer_codes, alignment_xmer_codes = oligo.get_design_from_records( alignment,
+                                                                                     options.windowSize,
+                                                                                     options.stepSize,
+                                                                                     options.XmerWindowSize,
+                                                                                     span_gaps,
+                                                                                     gap_constraint = gap_constraints,
+                                                                                     processes = options.threads,
+                                                                                     stats = stats,
+                                                                                     covered_codes = covered_codes,
+                                                                                     window_starts = window_starts,
+                                                                                     collect_xmers = not options.approximate
+                                                                                   )
+   alignment.close()
+
+   if options.profile:
+      profiler.disable()
+      profiler.dump_stats( output_name + ".prof" )
+
+   # Every xmer of the ymers is still covered, by as few of the ymers as the greedy choice finds
+   if options.design_mode == 'greedy':
+      with stats.stage( 'greedy_cover' ) as stage:
+         stage.add_items( len( ymer_table ) )
+         ymer_table, ymer_xmer_codes = oligo.greedy_cover( ymer_table, options.XmerWindowSize,
+                                                           span_gaps, covered_codes
+                                                         )
+
+   total_ymers = ymer_table.total_kmers
+
+   if options.approximate:
+      summary = approximate_summary( ymer_table, alignment_name, span_gaps, options, stats )
+      write_design( ymer_table, output_name, stats )
+
+      # The library index holds the exact xmers of the library, whatever the summary
+      if options.library_index and options.design_mode != 'greedy':
+         ymer_xmer_codes = oligo.get_xmer_codes_from_records( ymer_table.iter_records(),
+                                                               options.XmerWindowSize, span_gaps
+                                                             )
+      update_library_index( library_index, ymer_xmer_codes, stats, options )
+
+      if options.stats_json:
+         stats.write_json( output_name + STATS_SUFFIX, alignment = alignment_name, output = output_name,
+                           total_ymers = total_ymers, output_ymers = len( ymer_table ), **summary
+                         )
+      return
 
    # Calculate redundancy of each xmer in the output ymers
-   for current_output in set( subset_ymers ):
-     if current_output in win_xmers_dict:
-         win_xmers_dict[ current_output ] += 1 
+   with stats.stage( 'redundancy' ) as stage:
+      covered_xmers = oligo.count_shared_codes( ymer_xmer_codes, alignment_xmer_codes )
+      stage.add_items( len( ymer_xmer_codes ) )
 
-   oligo.write_fastas( output_names, output_seqs, output_name = options.outPut )
+   num_output = write_design( ymer_table, output_name, stats )
 
-   xmer_avg_redundancy = sum( win_xmers_dict.values() ) / float( len( win_xmers_dict ) )
-   percent_total = calculate_percentage( len( output_seqs ), total_ymers )
-   percent_output_xmers = calculate_percentage( len( subset_ymers ), len( win_xmers_dict ) ) 
+   xmer_avg_redundancy = covered_xmers / float( len( alignment_xmer_codes ) )
+   percent_total = calculate_percentage( num_output, total_ymers )
+   percent_output_xmers = calculate_percentage( len( ymer_xmer_codes ), len( alignment_xmer_codes ) ) 
 
-   print( "Final design includes %d %d-mers ( %.2f%% of total )" % ( len( output_seqs ), options.windowSize, percent_total ) )
-   print( "%d unique %d-mers in final %d-mers ( %.2f%% of total )" % ( len( subset_ymers), options.XmerWindowSize, options.windowSize, percent_output_xmers ) )
+   print( "Final design includes %d %d-mers ( %.2f%% of total )" % ( num_output, options.windowSize, percent_total ) )
+   print( "%d unique %d-mers in final %d-mers ( %.2f%% of total )" % ( len( ymer_xmer_codes ), options.XmerWindowSize, options.windowSize, percent_output_xmers ) )
    print( "Average redundancy of %d-mers in %d-mers: %.2f" % ( options.XmerWindowSize, options.windowSize, xmer_avg_redundancy ) )
 
+   if library_index is not None:
+      library_covered = oligo.count_shared_codes( alignment_xmer_codes, covered_codes )
+      print( "%d of %d unique %d-mers were already covered by the library index ( %.2f%% of total )" %
+             ( library_covered, len( alignment_xmer_codes ), options.XmerWindowSize,
+               calculate_percentage( library_covered, len( alignment_xmer_codes ) )
+             )
+           )
+
+   update_library_index( library_index, ymer_xmer_codes, stats, options )
+
+   if options.stats_json:
+      stats.write_json( output_name + STATS_SUFFIX,
+                        alignment = alignment_name,
+                        output = output_name,
+                        total_ymers = total_ymers,
+                        output_ymers = num_output,
+                        alignment_xmers = len( alignment_xmer_codes ),
+                        output_xmers = len( ymer_xmer_codes ),
+                        average_redundancy = xmer_avg_redundancy
+                      )
+
+
+def write_design( ymer_table, output_name, stats ):
+   """
+      Writes the ymers of ymer_table to output_name
+
+      Returns:
+         the number of ymers written
+   """
+   # The name of a ymer is only final once every sequence has been seen,
+   # so ymers are written straight from the table once it is complete
+   with stats.stage( 'write' ) as stage:
+      num_output = oligo.write_fasta_records( ymer_table.iter_records(), output_name = output_name )
+      stage.add_items( num_output )
+   return num_output
+
+
+def update_library_index( library_index, ymer_xmer_codes, stats, options ):
+   """
+      Rewrites the library index named by options.library_index, if any, to
+      cover ymer_xmer_codes along with what library_index already covered
+   """
+   # The index is updated to cover the new ymers too, so it always describes the whole library
+   if options.library_index:
+      with stats.stage( 'library_index' ) as stage:
+         library_codes = ymer_xmer_codes
+         if library_index is not None:
+            library_codes = oligo.merge_codes( library_index.get_codes(), ymer_xmer_codes, options.XmerWindowSize )
+            library_index.close()
+         stage.add_items( oligo.write_kmer_index( options.library_index, library_codes, options.XmerWindowSize ) )
+
+
+def approximate_summary( ymer_table, alignment_name, span_gaps, options, stats ):
+   """
+      Estimates the redundancy statistics of the design with a RedundancySketch, which
+      takes a second pass over alignment_name, and prints them with their errors
+
+      Returns:
+         a dict of the estimates and their errors
+   """
+   with stats.stage( 'redundancy' ) as stage:
+      sketch = oligo.RedundancySketch( options.XmerWindowSize, span_gaps, options.hll_error )
+      sketch.add_ymers( ymer_table.kmers )
+
+      alignment = oligo.open_fasta_records( alignment_name )
+      sketch.add_records( alignment )
+      alignment.close()
+      stage.add_items( sketch.alignment_windows )
+
+   # Errors of the distinct counts are given at two standard errors
+   two_errors = 2 * sketch.ymer_xmers.standard_error()
+   ymer_xmers = sketch.ymer_xmers.estimate()
+   alignment_xmers = sketch.alignment_xmers.estimate() or 1.0
+   shared_xmers, shared_error = sketch.shared_xmers()
+
+   xmer_avg_redundancy = shared_xmers / alignment_xmers
+   redundancy_error = shared_error / alignment_xmers + two_errors * xmer_avg_redundancy
+
+   print( "Final design includes %d %d-mers ( %.2f%% of total )" %
+          ( len( ymer_table ), options.windowSize, calculate_percentage( len( ymer_table ), ymer_table.total_kmers ) )
+        )
+   print( "About %d +/- %d unique %d-mers in final %d-mers ( %.2f%% of total )" %
+          ( ymer_xmers, two_errors * ymer_xmers, options.XmerWindowSize, options.windowSize,
+            calculate_percentage( ymer_xmers, alignment_xmers )
+          )
+        )
+   print( "Average redundancy of %d-mers in %d-mers: %.2f +/- %.2f" %
+          ( options.XmerWindowSize, options.windowSize, xmer_avg_redundancy, redundancy_error )
+        )
+
+   return { 'alignment_xmers': alignment_xmers,
+            'output_xmers': ymer_xmers,
+            'output_xmers_error': two_errors * ymer_xmers,
+            'average_redundancy': xmer_avg_redundancy,
+            'average_redundancy_error': redundancy_error
+          }
+
 
 def calculate_percentage( first, second ):
    """
@@ -123,6 +320,54 @@ def add_program_options( option_parser ):
                              action = "store_true"
 
    )
+   option_parser.add_option( '--batch', help = (
+      "File listing several alignments to design from within this one process, one per line, "
+      "each followed by a tab and the name of its output file. Replaces -a and -o. [None]"
+      )
+      )
+   option_parser.add_option( '--stats_json', action = "store_true", help = (
+      "Include to write the wall time, CPU time, peak memory, and number of items of each "
+      "stage of the program as JSON, to the name of the output file with " + STATS_SUFFIX + " appended."
+      )
+      )
+   option_parser.add_option( '--profile', action = "store_true", help = (
+      "Include to write cProfile data of the windowing of the alignment to the name "
+      "of the output file with .prof appended."
+      )
+      )
+   option_parser.add_option( '--design_mode', default = 'all', choices = [ 'all', 'greedy' ], help = (
+      "Which ymers to include in the design. 'all' includes every unique ymer, 'greedy' chooses "
+      "a small set of them that covers every xmer found in any of them, by repeatedly choosing "
+      "the ymer that covers the most xmers not yet covered. [all]"
+      )
+      )
+   option_parser.add_option( '--approximate', action = "store_true", help = (
+      "Include to estimate the redundancy statistics with a HyperLogLog of fixed size for each count "
+      "of distinct xmers, instead of holding every xmer of the alignment. Estimates are printed with "
+      "their errors. The alignment is read a second time to estimate them."
+      )
+      )
+   option_parser.add_option( '--hll_error', type = 'float', default = 0.01, help = (
+      "Relative standard error of the distinct xmer counts of --approximate. Each count "
+      "uses about 1.08 / hll_error ** 2 bytes. [0.01]"
+      )
+      )
+   option_parser.add_option( '--library_index', help = (
+      "Kmer index of the xmers covered by an existing library. Only ymers with an xmer the index "
+      "does not cover are written to the output, and the index is then updated to cover them as well. "
+      "Created from the design if it does not exist. [None]"
+      )
+      )
+   option_parser.add_option( '--index_library', help = (
+      "Fasta file of a finished library to build --library_index from, replacing any existing index. "
+      "If no alignment is given, the program exits once the index is built. [None]"
+      )
+      )
+   option_parser.add_option( '-t', '--threads', type = 'int', default = 1, help = (
+      "Number of processes to split the sequences of the alignment between when "
+      "creating windows. Output does not depend on this number. [1]"
+      )
+      )
 
     
   